@@ -0,0 +1,55 @@
+"""
+Measures the time needed to define document classes, which is what every
+web worker, Celery worker and management command pays on startup. No
+database or search servers need to be running unless --ensure-indices is
+passed.
+
+  python benchmarks/startup.py --classes 100
+"""
+import optparse
+import sys
+import time
+
+from django.conf import settings
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option("--classes", type = "int", default = 100, help = "Number of document classes to define.")
+  parser.add_option("--ensure-indices", action = "store_true", default = False,
+    help = "Also measure creating database indices (requires a running MongoDB).")
+  options, args = parser.parse_args()
+
+  settings.configure(
+    ITSY_MONGODB_SERVERS = ["localhost:27017"],
+    ITSY_MONGODB_DB = "itsy_benchmark",
+    ITSY_ELASTICSEARCH_SERVERS = ["localhost:9200"],
+    ITSY_ELASTICSEARCH_INDEX = "itsy_benchmark",
+  )
+
+  start = time.time()
+  import itsy
+  imported = time.time()
+
+  classes = []
+  for i in xrange(options.classes):
+    Meta = type("Meta", (), { "collection" : "benchmark_%d" % i })
+    classes.append(type("Benchmark%d" % i, (itsy.Document,), {
+      "__module__" : __name__,
+      "Meta" : Meta,
+      "title" : itsy.TextField(indexed = True),
+      "count" : itsy.IntegerField(indexed = True),
+      "created" : itsy.DateTimeField(),
+    }))
+  defined = time.time()
+
+  print "import itsy: %.3f s" % (imported - start)
+  print "define %d classes: %.3f s (%.2f ms/class)" % (
+    options.classes, defined - imported, (defined - imported) * 1000.0 / options.classes)
+
+  if options.ensure_indices:
+    for cls in classes:
+      cls._meta.ensure_indices()
+    print "ensure indices: %.3f s" % (time.time() - defined)
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,72 @@
+__all__ = [
+  "Aggregate",
+  "Count",
+  "Sum",
+  "Avg",
+  "Min",
+  "Max",
+]
+
+class Aggregate(object):
+  """
+  An abstract aggregate declaration that is evaluated on the database
+  server by `DbResultSet.aggregate`.
+  """
+  operator = None
+
+  def __init__(self, field):
+    """
+    Class constructor.
+
+    @param field: Itsy field name (subfields are separated by dots)
+    """
+    self.field = field
+
+  def serialize(self, document):
+    """
+    Serializes this aggregate into a MongoDB group accumulator.
+
+    @param document: Document class that is being aggregated
+    """
+    path = document._meta.resolve_subfield_hierarchy(self.field.split("."))
+    return { self.operator : "${0}".format(".".join(path)) }
+
+class Count(Aggregate):
+  """
+  Counts the number of documents in a group.
+  """
+  def __init__(self):
+    """
+    Class constructor.
+    """
+    super(Count, self).__init__(None)
+
+  def serialize(self, document):
+    """
+    Serializes this aggregate into a MongoDB group accumulator.
+    """
+    return { "$sum" : 1 }
+
+class Sum(Aggregate):
+  """
+  Computes the sum of field values in a group.
+  """
+  operator = "$sum"
+
+class Avg(Aggregate):
+  """
+  Computes the average of field values in a group.
+  """
+  operator = "$avg"
+
+class Min(Aggregate):
+  """
+  Computes the minimum of field values in a group.
+  """
+  operator = "$min"
+
+class Max(Aggregate):
+  """
+  Computes the maximum of field values in a group.
+  """
+  operator = "$max"
@@ -0,0 +1,441 @@
+import Queue
+import sys
+import threading
+import time
+
+from django.conf import settings
+
+class Future(object):
+  """
+  The result of an operation that is executed asynchronously.
+  """
+  def __init__(self):
+    """
+    Class constructor.
+    """
+    self._done = threading.Event()
+    self._result = None
+    self._exc_info = None
+    self._callbacks = []
+    self._lock = threading.Lock()
+
+  def set_result(self, result):
+    """
+    Completes the future with a result.
+    """
+    self._result = result
+    self._finish()
+
+  def set_exception(self, exc_info):
+    """
+    Completes the future with an exception.
+
+    @param exc_info: Exception information as returned by sys.exc_info
+    """
+    self._exc_info = exc_info
+    self._finish()
+
+  def _finish(self):
+    """
+    Marks the future as done and invokes callbacks.
+    """
+    with self._lock:
+      self._done.set()
+      callbacks, self._callbacks = self._callbacks, []
+
+    for callback in callbacks:
+      callback(self)
+
+  def done(self):
+    """
+    Returns true if the operation has completed.
+    """
+    return self._done.is_set()
+
+  def add_done_callback(self, callback):
+    """
+    Registers a callback that is invoked with this future once it completes.
+    """
+    with self._lock:
+      if not self._done.is_set():
+        self._callbacks.append(callback)
+        return
+
+    callback(self)
+
+  def exception(self, timeout = None):
+    """
+    Waits for the operation and returns its exception or None.
+    """
+    self.result(timeout, raise_exception = False)
+    return self._exc_info[1] if self._exc_info else None
+
+  def result(self, timeout = None, raise_exception = True):
+    """
+    Waits for the operation to complete and returns its result.
+
+    @param timeout: Optional timeout in seconds
+    """
+    if not self._done.wait(timeout):
+      raise RuntimeError("Timed out while waiting for the operation to complete!")
+
+    if self._exc_info is not None and raise_exception:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+    return self._result
+
+def _run(future, function, args, kwargs):
+  """
+  Runs a function and stores its outcome into a future.
+  """
+  try:
+    result = function(*args, **kwargs)
+  except:
+    future.set_exception(sys.exc_info())
+  else:
+    future.set_result(result)
+
+class ThreadPoolExecutor(object):
+  """
+  Executes operations using a pool of worker threads. The queue of pending
+  operations is bounded, so submitting blocks when workers fall behind.
+  Operations submitted from the worker threads themselves are executed
+  immediately, so that waiting for them cannot deadlock the pool.
+  """
+  def __init__(self, workers = 8, queue_size = 0):
+    """
+    Class constructor.
+
+    @param workers: Number of worker threads
+    @param queue_size: Maximum number of pending operations (0 for unbounded)
+    """
+    self._queue = Queue.Queue(queue_size)
+    self._threads = []
+    self._workers = workers
+    self._lock = threading.Lock()
+    self._local = threading.local()
+
+  def _worker(self):
+    """
+    Worker thread main loop.
+    """
+    self._local.worker = True
+    while True:
+      item = self._queue.get()
+      if item is None:
+        break
+
+      _run(*item)
+
+  def _start(self):
+    """
+    Starts worker threads if they are not running yet.
+    """
+    with self._lock:
+      while len(self._threads) < self._workers:
+        thread = threading.Thread(target = self._worker)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+  def submit(self, function, *args, **kwargs):
+    """
+    Schedules a function for execution, blocking while the queue of pending
+    operations is full. When called from a worker thread, the function is
+    executed immediately.
+
+    @return: A Future
+    """
+    future = Future()
+    if getattr(self._local, 'worker', False):
+      _run(future, function, args, kwargs)
+      return future
+
+    self._start()
+    self._queue.put((future, function, args, kwargs))
+    return future
+
+  def shutdown(self):
+    """
+    Stops all worker threads after pending operations complete.
+    """
+    with self._lock:
+      threads, self._threads = self._threads, []
+
+    for thread in threads:
+      self._queue.put(None)
+    for thread in threads:
+      thread.join()
+
+class SynchronousExecutor(object):
+  """
+  An executor that runs operations immediately in the calling thread. It
+  may be used as a local stand-in to make asynchronous operations
+  deterministic in tests.
+  """
+  def submit(self, function, *args, **kwargs):
+    """
+    Executes a function.
+
+    @return: A completed Future
+    """
+    future = Future()
+    _run(future, function, args, kwargs)
+    return future
+
+  def shutdown(self):
+    """
+    Does nothing.
+    """
+    pass
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+  """
+  Returns the executor used for asynchronous operations, creating it on
+  first use.
+  """
+  global _executor
+  if _executor is None:
+    with _executor_lock:
+      if _executor is None:
+        workers = getattr(settings, "ITSY_ASYNC_WORKERS", 8)
+        _executor = ThreadPoolExecutor(
+          workers,
+          getattr(settings, "ITSY_ASYNC_QUEUE_SIZE", workers * 4)
+        )
+
+  return _executor
+
+def set_executor(executor):
+  """
+  Replaces the executor used for asynchronous operations.
+
+  @param executor: An executor (for example SynchronousExecutor)
+  @return: The previous executor
+  """
+  global _executor
+  with _executor_lock:
+    previous, _executor = _executor, executor
+
+  return previous
+
+def submit(function, *args, **kwargs):
+  """
+  Schedules a function for asynchronous execution.
+
+  @return: A Future
+  """
+  return get_executor().submit(function, *args, **kwargs)
+
+def fan_out(*functions):
+  """
+  Invokes independent functions concurrently and returns their results in
+  order. The first function runs in the calling thread.
+
+  @param functions: Callables without arguments
+  @return: A list of results
+  """
+  if not functions:
+    return []
+
+  futures = [submit(function) for function in functions[1:]]
+  first = functions[0]()
+  return [first] + [future.result() for future in futures]
+
+def chunked(iterable, size):
+  """
+  Groups items of an iterable into lists of at most `size` items.
+  """
+  chunk = []
+  for item in iterable:
+    chunk.append(item)
+    if len(chunk) >= size:
+      yield chunk
+      chunk = []
+
+  if chunk:
+    yield chunk
+
+class PipelineStage(object):
+  """
+  A pipeline stage that processes items using one or more worker threads.
+  """
+  def __init__(self, name, function, workers):
+    """
+    Class constructor.
+
+    @param name: Stage name
+    @param function: Function invoked for every item
+    @param workers: Number of worker threads
+    """
+    self.name = name
+    self.function = function
+    self.workers = workers
+    self.processed = 0
+    self.busy_time = 0.0
+    self.queue_depth_total = 0
+    self.queue_depth_max = 0
+
+  def stats(self):
+    """
+    Returns stage statistics: number of processed items, time spent
+    processing them, throughput in items per second of processing time and
+    the average and maximum depth of the stage's input queue.
+    """
+    return {
+      'processed' : self.processed,
+      'busy_time' : self.busy_time,
+      'throughput' : self.processed / self.busy_time if self.busy_time else 0.0,
+      'queue_depth' : float(self.queue_depth_total) / self.processed if self.processed else 0.0,
+      'queue_depth_max' : self.queue_depth_max,
+    }
+
+class Pipeline(object):
+  """
+  Processes items through a sequence of stages connected by bounded
+  queues. Each stage runs in its own worker threads, so stages overlap,
+  while bounded queues apply backpressure on faster upstream stages.
+  """
+  _DONE = object()
+
+  def __init__(self, queue_size = 4):
+    """
+    Class constructor.
+
+    @param queue_size: Capacity of queues between stages
+    """
+    self.queue_size = queue_size
+    self.source = PipelineStage("source", None, 1)
+    self.stages = []
+    self._error = None
+    self._lock = threading.Lock()
+
+  def add_stage(self, function, workers = 1, name = None):
+    """
+    Appends a stage. The value returned by the function is passed on to the
+    next stage; None values are not passed on.
+
+    @param function: Function invoked for every item
+    @param workers: Number of worker threads
+    @param name: Optional stage name
+    """
+    self.stages.append(PipelineStage(name or function.__name__, function, workers))
+    return self
+
+  def _put(self, queue, item):
+    """
+    Puts an item into a queue, giving up when the pipeline has failed.
+    """
+    while self._error is None:
+      try:
+        queue.put(item, timeout = 0.1)
+        return True
+      except Queue.Full:
+        continue
+
+    return False
+
+  def _get(self, queue):
+    """
+    Gets an item from a queue, giving up when the pipeline has failed.
+    """
+    while self._error is None:
+      try:
+        return queue.get(timeout = 0.1)
+      except Queue.Empty:
+        continue
+
+    return Pipeline._DONE
+
+  def _worker(self, stage, input_queue, output_queue, remaining):
+    """
+    Stage worker thread main loop.
+    """
+    try:
+      while True:
+        item = self._get(input_queue)
+        if item is Pipeline._DONE:
+          # Let other workers of this stage know that input has been exhausted
+          self._put(input_queue, Pipeline._DONE)
+          break
+
+        depth = input_queue.qsize()
+        started = time.time()
+        result = stage.function(item)
+        with self._lock:
+          stage.processed += 1
+          stage.busy_time += time.time() - started
+          stage.queue_depth_total += depth
+          stage.queue_depth_max = max(stage.queue_depth_max, depth)
+
+        if result is not None and output_queue is not None:
+          self._put(output_queue, result)
+    except:
+      with self._lock:
+        if self._error is None:
+          self._error = sys.exc_info()
+    finally:
+      with self._lock:
+        remaining[0] -= 1
+        last = remaining[0] == 0
+
+      if last and output_queue is not None:
+        self._put(output_queue, Pipeline._DONE)
+
+  def run(self, source):
+    """
+    Feeds items from the source through all stages and waits for them to be
+    processed. The source is consumed in the calling thread and its
+    statistics are available as the `source` stage. The first
+    exception raised by any stage is re-raised.
+
+    @param source: An iterable of items
+    """
+    self._error = None
+    queues = [Queue.Queue(self.queue_size) for stage in self.stages]
+    threads = []
+    for i, stage in enumerate(self.stages):
+      output_queue = queues[i + 1] if i + 1 < len(queues) else None
+      remaining = [stage.workers]
+      for j in xrange(stage.workers):
+        thread = threading.Thread(target = self._worker, args = (stage, queues[i], output_queue, remaining))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    def fail():
+      with self._lock:
+        if self._error is None:
+          self._error = sys.exc_info()
+
+    try:
+      source = iter(source)
+      while True:
+        started = time.time()
+        try:
+          item = source.next()
+        except StopIteration:
+          break
+
+        self.source.processed += 1
+        self.source.busy_time += time.time() - started
+        if not self._put(queues[0], item):
+          break
+    except:
+      fail()
+    finally:
+      self._put(queues[0], Pipeline._DONE)
+      try:
+        # Join with a timeout so that the calling thread can be interrupted
+        for thread in threads:
+          while thread.is_alive():
+            thread.join(0.1)
+      except:
+        fail()
+        raise
+
+    if self._error is not None:
+      raise self._error[0], self._error[1], self._error[2]
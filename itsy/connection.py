@@ -4,15 +4,21 @@ from django.conf import settings
 
 from .store import DocumentStore
 from .search import DocumentSearch
+from .search.cache import SearchResultCache
 
 # Create a default document store connection
 store = DocumentStore(
   settings.ITSY_MONGODB_SERVERS,
-  settings.ITSY_MONGODB_DB
+  settings.ITSY_MONGODB_DB,
+  getattr(settings, "ITSY_MONGODB_OPTIONS", None)
 )
 
 # Create a default document search connection
 search = DocumentSearch(
   settings.ITSY_ELASTICSEARCH_SERVERS,
-  settings.ITSY_ELASTICSEARCH_INDEX
+  settings.ITSY_ELASTICSEARCH_INDEX,
+  getattr(settings, "ITSY_ELASTICSEARCH_OPTIONS", None)
 )
+
+# Create a default search result cache (disabled unless configured)
+search_cache = SearchResultCache(getattr(settings, "ITSY_SEARCH_CACHE", None))
@@ -3,8 +3,8 @@ from __future__ import absolute_import
 import copy
 import datetime
 
-from . import exceptions, signals, registry
-from . import tasks as common_tasks
+from . import concurrency, exceptions, indexer, outbox, signals, registry
+from .metrics import metrics
 from .meta import DocumentMetadata
 from .resultset import DbResultSet, SearchResultSet
 
@@ -151,6 +151,8 @@ class BaseDocument(object):
     """
     self._values = {}
     self._reference_fields = {}
+    self._deferred_fields = set()
+    self._partial_fields = set()
 
     # Handle additional arguments to constructor the same way as one would set attributes
     # on the document instance after it is instantiated
@@ -186,6 +188,8 @@ class BaseDocument(object):
     """
     self._values = {}
     self._reference_fields = {}
+    self._deferred_fields = set()
+    self._partial_fields = set()
     
     values = state
     for name, value in values.iteritems():
@@ -200,6 +204,8 @@ class BaseDocument(object):
     """
     self._values.clear()
     self._reference_fields.clear()
+    self._deferred_fields = set()
+    self._partial_fields = set()
     for key, value in data.iteritems():
       field = self._meta.get_field_by_db_name(key)
       if field is not None and value is not None:
@@ -240,6 +246,11 @@ class BaseDocument(object):
       if fields is not None and name not in fields:
         continue
 
+      # Skip fields that have not been (completely) loaded from the database, so
+      # their stored values are preserved
+      if field in self._deferred_fields or field in self._partial_fields:
+        continue
+
       value = self._values.get(field)
       if not field.no_pre_save:
         value = field.pre_save(value, self, update = update)
@@ -254,10 +265,13 @@ class BaseDocument(object):
     
     return document
   
-  def _search_prepare(self):
+  def _search_prepare(self, fields = None, null_values = False):
     """
     Prepares the document for saving into the search index. If this document
     is marked as non-indexable, this method will return None.
+
+    @param fields: Subset of fields to prepare for
+    @param null_values: Should missing values be included as None
     """
     if not self.should_save_to_search_index():
       return None
@@ -267,13 +281,62 @@ class BaseDocument(object):
     for name, field in self._meta.fields.iteritems():
       if not field.searchable:
         continue
+
+      if fields is not None and field not in fields:
+        continue
       
       value = self._values.get(field)
       if value is not None or field.virtual:
         document[field.name] = field.to_search(value, self)
+      elif null_values:
+        document[field.name] = None
     
     return document
 
+  @classmethod
+  def _search_fields_affected(cls, modified_fields):
+    """
+    Returns searchable fields that need to be updated in the search index
+    when the given fields have been modified.
+
+    @param modified_fields: Names of modified fields
+    @return: A set of fields or None when a complete update is required
+    """
+    affected = set()
+    for name, field in cls._meta.fields.iteritems():
+      if not field.searchable:
+        continue
+
+      dependencies = field.get_search_dependencies()
+      if dependencies is None:
+        return None
+      elif dependencies.intersection(modified_fields):
+        affected.add(field)
+
+    # Changes to fields that search hooks depend on require a complete update
+    dependencies = cls.get_search_hook_dependencies()
+    if dependencies is None or dependencies.intersection(modified_fields):
+      return None
+
+    return affected
+
+  @classmethod
+  def get_search_hook_dependencies(cls):
+    """
+    Returns names of fields that `get_search_boost` and
+    `should_save_to_search_index` depend on. When any of these hooks is
+    overriden, None is returned so that every modification updates the
+    search index; such classes may override this method to declare their
+    dependencies instead.
+
+    @return: A set of field names or None when unknown
+    """
+    for name in ('get_search_boost', 'should_save_to_search_index'):
+      if getattr(cls, name).im_func is not getattr(Document, name).im_func:
+        return None
+
+    return set()
+
   def _db_post_save(self):
     """
     Performs post-save actions on the document.
@@ -326,14 +389,26 @@ class Document(BaseDocument):
     Returns state for serialization.
     """
     super_state = super(Document, self).__getstate__()
-    return self.pk, self._version, super_state
+    unloaded = (
+      [field.name for field in self._deferred_fields],
+      [field.name for field in self._partial_fields],
+    )
+    return self.pk, self._version, super_state, unloaded
   
   def __setstate__(self, state):
     """
     Sets up state from serialized data.
     """
-    self.pk, self._version, super_state = state
+    if len(state) == 4:
+      pk, version, super_state, (deferred, partial) = state
+    else:
+      pk, version, super_state = state
+      deferred, partial = [], []
+
     super(Document, self).__setstate__(super_state)
+    self.pk, self._version = pk, version
+    self._deferred_fields = set(self._meta.fields[name] for name in deferred)
+    self._partial_fields = set(self._meta.fields[name] for name in partial)
     self._document_source = DocumentSource.Db
   
   def _set_from_db(self, data):
@@ -397,6 +472,32 @@ class Document(BaseDocument):
       raise exceptions.DoesNotExist
     
     self._set_from_db(document)
+
+  def _load_deferred(self):
+    """
+    Loads all fields that have been deferred or only partially loaded when
+    this document was fetched from the database. All such fields are fetched
+    using a single query.
+    """
+    fields = self._deferred_fields | self._partial_fields
+    if not fields:
+      return
+
+    document = self._meta.collection.find_one(
+      { "_id" : self._pk_for_db() },
+      fields = [field.db_name for field in fields]
+    )
+    if document is None:
+      raise exceptions.DoesNotExist
+
+    self._deferred_fields = set()
+    self._partial_fields = set()
+    for field in fields:
+      value = document.get(field.db_name)
+      if value is not None:
+        self._values[field] = field.from_store(value, self)
+      else:
+        self._values.pop(field, None)
   
   def save(self, snapshot = True, tasks = None, author = None, target = DocumentSource.Db):
     """
@@ -421,6 +522,14 @@ class Document(BaseDocument):
     elif target == DocumentSource.Search:
       self._save_to_search()
   
+  def asave(self, **kwargs):
+    """
+    Saves the document asynchronously. Accepts the same arguments as `save`.
+
+    @return: A Future
+    """
+    return concurrency.submit(self.save, **kwargs)
+
   def _modified_fields(self, old_document, document):
     """
     Returns names of all fields that have been modified between versions and
@@ -428,6 +537,9 @@ class Document(BaseDocument):
     """
     fields = set()
     for field in self._meta.fields.values():
+      if field in self._deferred_fields or field in self._partial_fields:
+        continue
+
       if document.get(field.db_name) != old_document.get(field.db_name):
         fields.add(field.name)
     
@@ -465,6 +577,12 @@ class Document(BaseDocument):
         else:
           d_set[key] = value
 
+      # Record the version of the last modification that affects the search
+      # index, as other modifications leave the indexed version behind
+      modified_fields = self._modified_fields(old_document, d_set)
+      if self._meta.searchable and self._search_fields_affected(modified_fields) != set():
+        d_set['_search_version'] = self._version + 1
+
       # Commit the document, incrementing version and releasing the update mutex
       document = {'$set': d_set, '$unset': d_unset, '$inc': {'_version': 1}}
       document['$set']['_mutex'] = datetime.datetime.utcnow() - datetime.timedelta(hours = 1)
@@ -472,6 +590,12 @@ class Document(BaseDocument):
         document['$set']['_last_update'] = datetime.datetime.utcnow()
         document['$set']['_last_author'] = author
 
+      # Tasks recorded in the outbox are written together with the document
+      pending = self._post_save_tasks(tasks, modified_fields)
+      recorded = outbox.recorded_tasks(pending)
+      if recorded:
+        document['$pushAll'] = { outbox.OUTBOX_FIELD : outbox.make_entries(recorded, modified_fields) }
+
       self._meta.collection.update(
         { "_id" : self._pk_for_db() },
         document,
@@ -480,7 +604,9 @@ class Document(BaseDocument):
       self._version += 1
       
       # Dispatch update tasks
-      self.dispatch_update_tasks(self.pk, tasks, self._modified_fields(old_document, document['$set']))
+      self._dispatch_post_save_tasks(
+        self._pk_for_db(), [task for task in pending if task not in recorded], modified_fields
+      )
     else:
       # A new document is being inserted
       document['_version'] = 1
@@ -494,14 +620,20 @@ class Document(BaseDocument):
         if value is None:
           del document[key]
 
+      # Tasks recorded in the outbox are written together with the document
+      tasks.update({ 'reference_cache' : False })
+      pending = self._post_save_tasks(tasks, None)
+      recorded = outbox.recorded_tasks(pending)
+      if recorded:
+        document[outbox.OUTBOX_FIELD] = outbox.make_entries(recorded, None)
+
       new_pk = self._meta.collection.insert(document, safe = True)
       if new_pk is not None:
         self.pk = self._meta.get_primary_key_field().from_store(new_pk, self)
       self._version = 1
     
       # Dispatch update tasks
-      tasks.update({ 'reference_cache' : False })
-      self.dispatch_update_tasks(self.pk, tasks, [])
+      self._dispatch_post_save_tasks(self._pk_for_db(), [task for task in pending if task not in recorded], None)
     
     self._document_source = DocumentSource.Db
     self._db_post_save()
@@ -556,17 +688,50 @@ class Document(BaseDocument):
     Dispatches tasks that will update external documents and search indices in
     the background.
     
-    @param pk: Document primary key
+    @param pk: Document primary key (formatted for the database)
     @param tasks: Which tasks should be invoked
-    @param modified_fields: Fields that have been modified
+    @param modified_fields: Fields that have been modified (None when unknown)
     """
+    cls._dispatch_post_save_tasks(pk, cls._post_save_tasks(tasks, modified_fields), modified_fields)
+
+  @classmethod
+  def _post_save_tasks(cls, tasks, modified_fields):
+    """
+    Returns names of background tasks (as defined in itsy.outbox) that need
+    to be invoked after a document has been saved.
+
+    @param tasks: Which tasks should be invoked
+    @param modified_fields: Fields that have been modified (None when unknown)
+    """
+    pending = []
     if tasks.get('reference_cache', False):
-      # Dispatch task for syncing the cached references
-      common_tasks.cache_spawn_syncers.delay(cls, pk, modified_fields)
-    
+      pending.append(outbox.CACHE_SYNC)
+
     if tasks.get('search_indices', False) and cls._meta.searchable:
+      if modified_fields is not None and not cls._search_fields_affected(modified_fields):
+        # No searchable data has changed, so the search index is still valid
+        metrics.increment("search_index.update_skipped")
+      else:
+        pending.append(outbox.SEARCH_UPDATE)
+
+    return pending
+
+  @classmethod
+  def _dispatch_post_save_tasks(cls, pk, pending, modified_fields):
+    """
+    Dispatches the given background tasks.
+
+    @param pk: Document primary key (formatted for the database)
+    @param pending: Names of tasks as returned by `_post_save_tasks`
+    @param modified_fields: Fields that have been modified (None when unknown)
+    """
+    if outbox.CACHE_SYNC in pending:
+      # Dispatch task for syncing the cached references
+      outbox.dispatch_cache_sync(cls, [pk], modified_fields)
+
+    if outbox.SEARCH_UPDATE in pending:
       # Dispatch task for updating search indices
-      common_tasks.search_index_update.delay(cls, pk)
+      indexer.dispatch_update(cls, [pk], modified_fields)
   
   def revert(self, version, author = None):
     """
@@ -588,9 +753,14 @@ class Document(BaseDocument):
     """
     return 1.0
   
-  def _save_to_search(self):
+  def _save_to_search(self, bulk = False, fields = None):
     """
-    Saves the document into Elastic Search.
+    Saves the document into Elastic Search. When modified fields are given,
+    only the affected searchable fields are sent as a partial update if
+    possible; otherwise the complete document is indexed.
+
+    @param bulk: Should the operation be queued for a bulk request
+    @param fields: Optional names of fields that have been modified
     """
     if self.pk is None:
       raise exceptions.DocumentNotSaved
@@ -600,13 +770,54 @@ class Document(BaseDocument):
     
     if self._document_source != DocumentSource.Db:
       self.refresh()
+    else:
+      self._load_deferred()
 
+    if fields is not None and not bulk and self._save_to_search_partial(fields):
+      return
+
+    # Index using external versioning so that stale writes get rejected
+    self._meta.search_engine.index(self._search_document(), bulk = bulk, version = self._version)
+
+  def _search_document(self):
+    """
+    Returns the complete search document, ready to be indexed. All fields
+    must already be loaded.
+    """
     document = self._search_prepare()
     document['_id'] = document[self._meta.get_primary_key_field().name]
     document['_version'] = self._version
     document['_boost'] = float(self.get_search_boost())
+    return document
 
-    self._meta.search_engine.index(document)
+  def _save_to_search_partial(self, fields):
+    """
+    Attempts to update only those searchable fields that are affected by
+    modification of the given fields.
+
+    @param fields: Names of fields that have been modified
+    @return: True on success, False when the complete document must be indexed
+    """
+    affected = self._search_fields_affected(fields)
+    if affected is None:
+      return False
+
+    # Objects are merged by partial updates, so removed subfields would persist
+    for field in affected:
+      if field.get_search_mapping().get("type") == "object":
+        return False
+
+    document = self._search_prepare(fields = affected, null_values = True)
+    document['_version'] = self._version
+    document['_boost'] = float(self.get_search_boost())
+
+    # Updates increment the indexed version by one, so they are only applied on
+    # top of the immediately preceding version to keep versions in sync
+    return self._meta.search_engine.update(
+      self._pk_for_db(search = True),
+      document,
+      version = self._version - 1
+    )
 
   def _pk_for_db(self, search = False):
     """
@@ -630,8 +841,8 @@ class Document(BaseDocument):
     """
     cascade_documents = []
     for doc_class, field_path, field in self._meta.reverse_references:
-      documents = doc_class.find(**{ field_path.replace('.', '__') : self.pk })
-      if field.on_delete == RESTRICT and documents.count() > 0:
+      documents = doc_class.find(**{ field_path.replace('.', '__') : self.pk }).read_preference("PRIMARY")
+      if field.on_delete == RESTRICT and documents.exists():
         raise exceptions.DeleteRestrictedByReference
       elif field.on_delete == CASCADE:
         for document in documents:
@@ -649,16 +860,26 @@ class Document(BaseDocument):
     
     # Acquire the editorial mutex before deleting this document
     self._lock(False)
+    if self._meta.searchable:
+      indexer.prepare_remove(self.__class__, [pk], [self._version])
     self._meta.collection.remove(pk, safe = True)
     if self._meta.revisable:
       self._meta.revisions.remove({ "doc" : pk }, safe = True)
     if self._meta.searchable:
-      common_tasks.search_index_remove.delay(self.__class__, self._pk_for_db(search = True))
+      indexer.dispatch_remove(self.__class__, [pk], [self._version])
     
     # Delete all referenced documents
     for document in cascade_documents:
       document.delete()
 
+  def adelete(self):
+    """
+    Deletes this document asynchronously.
+
+    @return: A Future
+    """
+    return concurrency.submit(self.delete)
+
   @classmethod
   def find(cls, **criteria):
     """
@@ -669,9 +890,28 @@ class Document(BaseDocument):
   @classmethod
   def get(cls, **criteria):
     """
-    Retrieves a single document matching some criteria.
+    Retrieves a single document matching some criteria. The document is
+    always read from the primary.
+    """
+    return cls.find(**criteria).read_preference("PRIMARY").one()
+
+  @classmethod
+  def aget(cls, **criteria):
+    """
+    Retrieves a single document matching some criteria asynchronously.
+
+    @return: A Future
+    """
+    return concurrency.submit(cls.get, **criteria)
+
+  @classmethod
+  def afind(cls, **criteria):
+    """
+    Fetches all documents matching some criteria asynchronously.
+
+    @return: A Future resolving to a list of documents
     """
-    return cls.find(**criteria).one()
+    return cls.find(**criteria).afetch()
 
   @classmethod
   def get_or_create(cls, **criteria):
@@ -679,7 +919,7 @@ class Document(BaseDocument):
     Retrieves a document matching some criteria or creates a new one.
     """
     try:
-      return cls.find(**criteria).one()
+      return cls.get(**criteria)
     except cls.DoesNotExist:
       doc = cls(**criteria)
       return doc
@@ -698,6 +938,8 @@ class Document(BaseDocument):
     Syncs a referenced document field that is identified by its path in
     the embedded document hierarchy.
     """
+    # Cached references can only be found once all fields are loaded
+    self._load_deferred()
     for ref in self._reference_fields.get("{0}/{1}".format(path, document.pk), []):
       ref.sync(document)
   
@@ -713,7 +955,7 @@ class Document(BaseDocument):
         continue
       
       # Attempt to find referencing documents for the given identifier
-      for doc_id in doc_class.find(**{ field_path.replace('.', '__') : self.pk }).ids():
+      for doc_id in doc_class.find(**{ field_path.replace('.', '__') : self.pk }).read_preference("PRIMARY").ids():
         refs.setdefault((doc_class, doc_id), []).append(field_path)
     
     return refs
@@ -14,3 +14,9 @@ class DocumentNotSaved(Exception):
 class DeleteRestrictedByReference(Exception):
   pass
 
+class SearchBulkError(Exception):
+  pass
+
+class SearchBulkRejected(SearchBulkError):
+  pass
+
@@ -2,6 +2,7 @@ from __future__ import absolute_import
 
 import datetime
 import re
+import string
 import unicodedata
 
 from ..document import Document, EmbeddedDocument, RESTRICT, CASCADE
@@ -107,6 +108,12 @@ class Field(object):
     Returns the value of this field.
     """
     value = obj._values.get(self)
+    if (value is None and self in obj._deferred_fields) or self in obj._partial_fields:
+      # Field has not been (completely) loaded from the database yet; partially
+      # loaded fields must be loaded before their subfields can be modified
+      obj._load_deferred()
+      value = obj._values.get(self)
+
     if value is None and self.default is not None:
       obj._values[self] = value = self.default()
     
@@ -123,6 +130,8 @@ class Field(object):
     Sets the value for this field.
     """
     obj._values[self] = value
+    obj._deferred_fields.discard(self)
+    obj._partial_fields.discard(self)
   
   def contribute_to_class(self, cls, name):
     """
@@ -270,6 +279,32 @@ class Field(object):
     """
     pass
 
+  def get_search_dependencies(self):
+    """
+    Returns a set of names of document fields whose modification requires
+    this field to be updated in the search index. None may be returned when
+    dependencies cannot be determined.
+    """
+    if self.virtual:
+      return None
+
+    return set([self.name])
+
+  def get_save_dependencies(self):
+    """
+    Returns a set of names of other document fields from which the value of
+    this field is derived when saving. None may be returned when the value
+    may depend on the whole document.
+    """
+    return set()
+
+  def get_validation_dependencies(self):
+    """
+    Returns a set of names of other document fields against which this
+    field is validated.
+    """
+    return set()
+
 class TextField(Field):
   """
   A simple text field.
@@ -504,6 +539,15 @@ class DayField(IntegerField):
       except (AttributeError, ValueError):
         raise ValidationError("Invalid day for field '{0}' when validated against month and year!".format(self.name))
 
+  def get_validation_dependencies(self):
+    """
+    Returns names of the month and year fields this field is validated against.
+    """
+    if self.validate_month is None:
+      return set()
+
+    return set([self.validate_year, self.validate_month])
+
 class DateTimeField(Field):
   """
   Date and time combined field.
@@ -565,6 +609,23 @@ class SlugField(TextField):
     value = unicode(re.sub('[^\w\s-]', '', value).strip().lower())
     return re.sub('[-\s]+', '-', value)
 
+  def get_save_dependencies(self):
+    """
+    Returns names of fields referenced by the template.
+    """
+    dependencies = set()
+    for literal, field_name, spec, conversion in string.Formatter().parse(unicode(self.template)):
+      if field_name is None:
+        continue
+
+      path = re.split(r"[.\[]", field_name)
+      if path[0] != 'self' or len(path) < 2:
+        return None
+
+      dependencies.add(path[1])
+
+    return dependencies
+
 class EnumField(TextField):
   """
   Field that may contain one of the many predefined values.
@@ -962,3 +1023,19 @@ class DynamicField(Field):
 
   def get_search_mapping(self):
     return self.subfield.get_search_mapping()
+
+  def get_search_dependencies(self):
+    """
+    Returns names of fields this field depends on. The computed value is
+    stored, so its own modification is always detected.
+    """
+    return set([self.name]).union(self.on_change or [])
+
+  def get_save_dependencies(self):
+    """
+    Returns names of fields that trigger recomputation of this field.
+    """
+    if self.on_change is None:
+      return None
+
+    return set(self.on_change)
@@ -163,6 +163,13 @@ class ReverseCachedReferenceDescriptor(Field):
     Converts value from Elastic Search store.
     """
     return value
+
+  def get_search_dependencies(self):
+    """
+    Reverse references only depend on referencing documents, so modification
+    of this document's fields never requires an update.
+    """
+    return set()
   
   def to_search(self, value, document):
     """
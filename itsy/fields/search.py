@@ -1,4 +1,5 @@
 import re
+import string
 
 from .base import Field
 from ..search.analyzer import ExactTermAnalyzer
@@ -36,6 +37,23 @@ class SearchCompositeField(Field):
     """
     return self.composition.format(**{ 'self' : obj })
 
+  def get_search_dependencies(self):
+    """
+    Returns names of fields referenced by the composition.
+    """
+    dependencies = set()
+    for literal, field_name, spec, conversion in string.Formatter().parse(self.composition):
+      if field_name is None:
+        continue
+
+      path = re.split(r"[.\[]", field_name)
+      if path[0] != 'self' or len(path) < 2:
+        return None
+
+      dependencies.add(path[1])
+
+    return dependencies
+
   def to_search(self, value, document):
     """
     Converts value to Elastic Search store.
@@ -85,6 +103,12 @@ class SearchCopyField(Field):
     """
     return unicode(getattr(obj, self.copy_from))
 
+  def get_search_dependencies(self):
+    """
+    Returns names of fields this field depends on.
+    """
+    return set([self.copy_from])
+
   def to_search(self, value, document):
     """
     Converts value to Elastic Search store.
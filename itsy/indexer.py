@@ -0,0 +1,590 @@
+from __future__ import absolute_import
+
+import collections
+import threading
+import time
+
+import pymongo
+import pymongo.errors
+from django.conf import settings
+
+from . import registry
+from . import tasks as common_tasks
+from .connection import store, search_cache
+from .metrics import metrics
+
+# Change operations
+UPDATE = "u"
+DELETE = "d"
+
+# Document fields holding internal bookkeeping (editorial mutexes and the
+# task outbox), whose modification does not change indexed data
+INTERNAL_FIELDS = frozenset([
+  "_mutex", "_mutex_owner", "_outbox", "_outbox_owner", "_outbox_claimed_until", "_outbox_attempts",
+])
+
+def indexer_mode():
+  """
+  Returns how search indices are kept up to date. With "tasks" (the default)
+  Celery tasks are dispatched after every change. With "changelog" changes
+  are appended to a capped change log collection and with "oplog" nothing
+  is recorded, as the indexer daemon tails the MongoDB oplog.
+  """
+  return getattr(settings, "ITSY_SEARCH_INDEXER", "tasks")
+
+def _db_pks(doc_class, pks):
+  """
+  Converts primary keys into the database format, so that keys given as
+  document values (for example ObjectIds as strings) compare equal to keys
+  read from the database.
+
+  @param doc_class: Document class
+  @param pks: A list of primary keys (document values or formatted for the database)
+  """
+  pk_field = doc_class._meta.get_primary_key_field()
+  return [pk_field.to_store(pk_field.from_store(pk, None), None) for pk in pks]
+
+def dispatch_update(doc_class, pks, modified_fields = None):
+  """
+  Requests search index updates for the given documents.
+
+  @param doc_class: Document class
+  @param pks: A list of primary keys (formatted for the database)
+  @param modified_fields: Optional names of modified fields for partial updates
+  """
+  from . import outbox
+
+  pks = _db_pks(doc_class, pks)
+  mode = indexer_mode()
+  if mode == "tasks" and outbox.outbox_enabled():
+    outbox.get_outbox().append(outbox.SEARCH_UPDATE, doc_class, pks, modified_fields)
+  elif mode == "tasks":
+    if len(pks) == 1:
+      common_tasks.search_index_update.delay(doc_class, pks[0], modified_fields)
+    else:
+      common_tasks.search_index_update_batch.delay(doc_class, pks)
+  elif mode == "changelog":
+    get_changelog().append(doc_class, UPDATE, pks)
+
+def prepare_remove(doc_class, pks, versions = None):
+  """
+  Prepares removal of the given documents from the search index and must be
+  called before they are deleted. When the task outbox is enabled, removals
+  are recorded now, so that they are not lost when the process fails after
+  the documents have been deleted.
+
+  @param doc_class: Document class
+  @param pks: A list of primary keys (formatted for the database)
+  @param versions: Optional list of last versions of the deleted documents
+  """
+  from . import outbox
+
+  if indexer_mode() == "tasks" and outbox.outbox_enabled():
+    outbox.get_outbox().append(outbox.SEARCH_REMOVE, doc_class, pks, versions = versions)
+
+def dispatch_remove(doc_class, pks, versions = None):
+  """
+  Requests removal of the given documents from the search index after they
+  have been deleted. Removals are versioned when the last versions of the
+  deleted documents are given, so that delayed index updates are rejected.
+
+  @param doc_class: Document class
+  @param pks: A list of primary keys (formatted for the database)
+  @param versions: Optional list of last versions of the deleted documents
+  """
+  from . import outbox
+
+  pks = _db_pks(doc_class, pks)
+  mode = indexer_mode()
+  if mode == "tasks" and outbox.outbox_enabled():
+    # Removals have already been recorded by prepare_remove
+    return
+  elif mode == "tasks":
+    pk_field = doc_class._meta.get_primary_key_field()
+    search_ids = [pk_field.to_search(pk_field.from_store(pk, None), None) for pk in pks]
+    if len(search_ids) == 1:
+      common_tasks.search_index_remove.delay(doc_class, search_ids[0], versions[0] if versions else None)
+    else:
+      common_tasks.search_index_remove_batch.delay(doc_class, search_ids, versions)
+  elif mode == "changelog":
+    get_changelog().append(doc_class, DELETE, pks, versions)
+
+def _class_key(doc_class):
+  """
+  Returns a key that identifies the given document class.
+  """
+  return "{0}.{1}".format(doc_class._meta.collection_base, doc_class._meta.classname)
+
+def _searchable_classes():
+  """
+  Returns a list of all registered searchable document classes.
+  """
+  return [
+    cls for cls in registry.document_registry
+    if cls._meta.searchable and not cls._meta.abstract and not cls._meta.embedded
+  ]
+
+class Change(object):
+  """
+  A single change of a document.
+  """
+  def __init__(self, position, doc_class, operation, pk, version = None):
+    """
+    Class constructor.
+
+    @param position: Source position after this change
+    @param doc_class: Document class
+    @param operation: UPDATE or DELETE
+    @param pk: Primary key (formatted for the database)
+    @param version: Optional last version of a deleted document
+    """
+    self.position = position
+    self.doc_class = doc_class
+    self.operation = operation
+    self.pk = pk
+    self.version = version
+
+class MemoryChangeSource(object):
+  """
+  An in-memory change source that may be used in place of the change log
+  in tests. Positions are indices into the list of changes.
+  """
+  def __init__(self):
+    """
+    Class constructor.
+    """
+    self._changes = []
+    self._condition = threading.Condition()
+
+  def append(self, doc_class, operation, pks, versions = None):
+    """
+    Records changes of the given documents.
+
+    @param doc_class: Document class
+    @param operation: UPDATE or DELETE
+    @param pks: A list of primary keys (formatted for the database)
+    @param versions: Optional list of last versions of deleted documents
+    """
+    if versions is None:
+      versions = [None] * len(pks)
+
+    with self._condition:
+      for pk, version in zip(pks, versions):
+        self._changes.append(Change(len(self._changes) + 1, doc_class, operation, pk, version))
+      self._condition.notify_all()
+
+  def read(self, position, limit, timeout):
+    """
+    Returns at most `limit` changes after the given position, waiting up to
+    `timeout` seconds for changes to arrive.
+
+    @param position: Position of the last processed change (None to start at the beginning)
+    @param limit: Maximum number of changes
+    @param timeout: Maximum time to wait for changes
+    """
+    position = position or 0
+    with self._condition:
+      if len(self._changes) <= position:
+        self._condition.wait(timeout)
+      return self._changes[position:position + limit]
+
+  def reset(self):
+    """
+    Discards any read-ahead state.
+    """
+    pass
+
+class ChangeLogSource(object):
+  """
+  A change log stored in a capped MongoDB collection. Documents append
+  changes when they are saved or deleted; positions are identifiers of
+  change log entries.
+  """
+  def __init__(self, name = "itsy.changelog", size = 100 * 1024 * 1024):
+    """
+    Class constructor.
+
+    @param name: Collection name
+    @param size: Size of the capped collection in bytes
+    """
+    self.name = name
+    self.size = size
+    self._classes = None
+    self._cursor = None
+    self._ensured = False
+
+  def _collection(self):
+    """
+    Returns the change log collection, creating it as a capped collection
+    if it does not exist yet.
+    """
+    if not self._ensured:
+      try:
+        store.db.create_collection(self.name, capped = True, size = self.size)
+      except pymongo.errors.CollectionInvalid:
+        pass
+      self._ensured = True
+
+    return store.collection(self.name)
+
+  def append(self, doc_class, operation, pks, versions = None):
+    """
+    Records changes of the given documents.
+
+    @param doc_class: Document class
+    @param operation: UPDATE or DELETE
+    @param pks: A list of primary keys (formatted for the database)
+    @param versions: Optional list of last versions of deleted documents
+    """
+    if versions is None:
+      versions = [None] * len(pks)
+
+    class_key = _class_key(doc_class)
+    self._collection().insert(
+      [{ "c" : class_key, "o" : operation, "k" : pk, "v" : version } for pk, version in zip(pks, versions)],
+      safe = True
+    )
+
+  def _open(self, position):
+    """
+    Opens a tailable cursor positioned after the given entry. Entry
+    identifiers are ObjectIds, which increase with insertion time, so the
+    cursor only returns entries with greater identifiers. When the entry has
+    already been overwritten, all remaining entries are returned and the gap
+    is counted.
+    """
+    collection = self._collection()
+    if position is not None and collection.find_one({ "_id" : position }) is None:
+      metrics.increment("indexer.changelog_gaps")
+      position = None
+
+    spec = {}
+    if position is not None:
+      spec["_id"] = { "$gt" : position }
+    return collection.find(spec, tailable = True, await_data = True).sort("$natural", pymongo.ASCENDING)
+
+  def read(self, position, limit, timeout):
+    """
+    Returns at most `limit` changes after the given position, waiting up to
+    `timeout` seconds for changes to arrive.
+
+    @param position: Position of the last processed change (None to start at the beginning)
+    @param limit: Maximum number of changes
+    @param timeout: Maximum time to wait for changes
+    """
+    if self._classes is None:
+      self._classes = dict((_class_key(cls), cls) for cls in _searchable_classes())
+
+    if self._cursor is None or not self._cursor.alive:
+      self._cursor = self._open(position)
+
+    changes = []
+    deadline = time.time() + timeout
+    while len(changes) < limit and self._cursor.alive:
+      try:
+        entry = self._cursor.next()
+      except StopIteration:
+        if changes or time.time() >= deadline:
+          break
+        continue
+
+      doc_class = self._classes.get(entry["c"])
+      if doc_class is not None:
+        changes.append(Change(entry["_id"], doc_class, entry["o"], entry["k"], entry.get("v")))
+
+    if not changes and not self._cursor.alive:
+      # Tailable cursors on empty collections die immediately
+      time.sleep(timeout)
+
+    return changes
+
+  def reset(self):
+    """
+    Discards the open cursor, so that reading resumes at the given position.
+    """
+    self._cursor = None
+
+def _internal_update(update):
+  """
+  Returns True when an oplog update only modifies internal bookkeeping
+  fields (for example acquiring an editorial mutex).
+
+  @param update: Update document of an oplog entry
+  """
+  if not update:
+    return False
+
+  for operator, fields in update.iteritems():
+    if not operator.startswith("$"):
+      # Documents replaced as a whole may have changed arbitrarily
+      return False
+    elif not isinstance(fields, dict):
+      continue
+
+    for path in fields:
+      if path.split(".")[0] not in INTERNAL_FIELDS:
+        return False
+
+  return True
+
+class OplogSource(object):
+  """
+  A change source that tails the MongoDB replica set oplog. Positions are
+  oplog timestamps. Updates that only modify internal bookkeeping fields
+  are skipped.
+  """
+  def __init__(self, oplog = "oplog.rs"):
+    """
+    Class constructor.
+
+    @param oplog: Name of the oplog collection in the local database
+    """
+    self.oplog = oplog
+    self._namespaces = None
+    self._cursor = None
+
+  def _oplog_collection(self):
+    """
+    Returns the oplog collection.
+    """
+    return store.db.connection.local[self.oplog]
+
+  def _open(self, position):
+    """
+    Opens a tailable cursor positioned after the given timestamp. Without a
+    position, only changes made from now on are returned.
+    """
+    collection = self._oplog_collection()
+    if position is None:
+      for entry in collection.find().sort("$natural", pymongo.DESCENDING).limit(1):
+        position = entry["ts"]
+
+    spec = { "ns" : { "$in" : self._namespaces.keys() } }
+    if position is not None:
+      spec["ts"] = { "$gt" : position }
+    return collection.find(spec, tailable = True, await_data = True)
+
+  def read(self, position, limit, timeout):
+    """
+    Returns at most `limit` changes after the given position, waiting up to
+    `timeout` seconds for changes to arrive.
+
+    @param position: Timestamp of the last processed change (None to start now)
+    @param limit: Maximum number of changes
+    @param timeout: Maximum time to wait for changes
+    """
+    if self._namespaces is None:
+      self._namespaces = collections.defaultdict(list)
+      for cls in _searchable_classes():
+        self._namespaces["{0}.{1}".format(store.db.name, cls._meta.collection_base)].append(cls)
+
+    if self._cursor is None or not self._cursor.alive:
+      self._cursor = self._open(position)
+
+    changes = []
+    deadline = time.time() + timeout
+    while len(changes) < limit and self._cursor.alive:
+      try:
+        entry = self._cursor.next()
+      except StopIteration:
+        if changes or time.time() >= deadline:
+          break
+        continue
+
+      if entry["op"] == "i":
+        operation, pk = UPDATE, entry["o"]["_id"]
+      elif entry["op"] == "u":
+        if _internal_update(entry["o"]):
+          metrics.increment("indexer.internal_updates")
+          continue
+        operation, pk = UPDATE, entry["o2"]["_id"]
+      elif entry["op"] == "d":
+        operation, pk = DELETE, entry["o"]["_id"]
+      else:
+        continue
+
+      for doc_class in self._namespaces.get(entry["ns"], []):
+        changes.append(Change(entry["ts"], doc_class, operation, pk))
+
+    if not changes and not self._cursor.alive:
+      time.sleep(timeout)
+
+    return changes
+
+  def reset(self):
+    """
+    Discards the open cursor, so that reading resumes at the given position.
+    """
+    self._cursor = None
+
+def apply_changes(changes):
+  """
+  Applies a batch of changes to the search indices. Changes are
+  deduplicated per document and applied per document class using a single
+  database query and a single bulk request.
+
+  @param changes: A list of Change instances
+  """
+  # Only the last change of every document matters
+  pending = collections.OrderedDict()
+  for change in changes:
+    pk = _db_pks(change.doc_class, [change.pk])[0]
+    pending.setdefault(change.doc_class, collections.OrderedDict())[pk] = change
+
+  for doc_class, latest in pending.iteritems():
+    engine = doc_class._meta.search_engine
+    pk_field = doc_class._meta.get_primary_key_field()
+    updated = [pk for pk, change in latest.iteritems() if change.operation == UPDATE]
+    removed = set(pk for pk, change in latest.iteritems() if change.operation == DELETE)
+
+    # Lines are kept local instead of using the shared queue of bulk
+    # operations, which may contain operations of other threads
+    lines = []
+    if updated:
+      found = set()
+      for document in doc_class.find(pk__in = updated).read_preference("PRIMARY").defer(None):
+        found.add(document._pk_for_db())
+        if document.should_save_to_search_index():
+          lines.extend(engine.index_action(document._search_document(), document._version))
+
+      # Documents may have been deleted after the change has been recorded
+      removed.update(pk for pk in updated if pk not in found)
+
+    # Removals are versioned when the last versions of documents are known
+    for pk in removed:
+      lines.append(engine.delete_action(pk_field.to_search(pk_field.from_store(pk, None), None), latest[pk].version))
+
+    engine.send_bulk(lines)
+    search_cache.invalidate(doc_class)
+    metrics.increment("indexer.updated", len(updated))
+    metrics.increment("indexer.removed", len(removed))
+
+  metrics.increment("indexer.changes", len(changes))
+
+class MemoryPositionStore(object):
+  """
+  Keeps indexer positions in memory, for use in tests.
+  """
+  def __init__(self):
+    """
+    Class constructor.
+    """
+    self._positions = {}
+
+  def load(self, name):
+    """
+    Returns the stored position of the given indexer or None.
+    """
+    return self._positions.get(name)
+
+  def save(self, name, position):
+    """
+    Stores the position of the given indexer.
+    """
+    self._positions[name] = position
+
+class MongoPositionStore(object):
+  """
+  Persists indexer positions in a MongoDB collection, so that indexing can
+  resume where it stopped.
+  """
+  def __init__(self, name = "itsy.indexer"):
+    """
+    Class constructor.
+
+    @param name: Collection name
+    """
+    self.collection = store.collection(name)
+
+  def load(self, name):
+    """
+    Returns the stored position of the given indexer or None.
+    """
+    state = self.collection.find_one({ "_id" : name })
+    return state["position"] if state is not None else None
+
+  def save(self, name, position):
+    """
+    Stores the position of the given indexer.
+    """
+    self.collection.update(
+      { "_id" : name },
+      { "$set" : { "position" : position, "updated" : time.time() } },
+      upsert = True,
+      safe = True
+    )
+
+class SearchIndexer(object):
+  """
+  Keeps search indices up to date by consuming changes from a change source.
+  Changes are batched, deduplicated per document and applied per document
+  class using bulk requests. The position of the last applied change is
+  persisted after every batch.
+  """
+  def __init__(self, source, name = "default", batch_size = 500, timeout = 1.0, positions = None):
+    """
+    Class constructor.
+
+    @param source: Change source (ChangeLogSource, OplogSource or MemoryChangeSource)
+    @param name: Indexer name under which the position is persisted
+    @param batch_size: Maximum number of changes applied in a single batch
+    @param timeout: Maximum time to wait for a batch to fill up
+    @param positions: Position store (defaults to MongoPositionStore)
+    """
+    self.source = source
+    self.name = name
+    self.batch_size = batch_size
+    self.timeout = timeout
+    self.positions = positions if positions is not None else MongoPositionStore()
+    self.position = self.positions.load(name)
+    self._stopped = threading.Event()
+
+  def run_once(self):
+    """
+    Reads and applies a single batch of changes.
+
+    @return: Number of processed changes
+    """
+    changes = self.source.read(self.position, self.batch_size, self.timeout)
+    if not changes:
+      return 0
+
+    try:
+      apply_changes(changes)
+    except:
+      # Changes that have been read must be read again
+      self.source.reset()
+      raise
+    self.position = changes[-1].position
+    self.positions.save(self.name, self.position)
+    return len(changes)
+
+  def run(self):
+    """
+    Applies changes until stopped. Failed batches are retried.
+    """
+    while not self._stopped.is_set():
+      try:
+        self.run_once()
+      except Exception:
+        metrics.increment("indexer.errors")
+        time.sleep(self.timeout)
+
+  def stop(self):
+    """
+    Requests the indexer to stop after the current batch.
+    """
+    self._stopped.set()
+
+_changelog = None
+
+def get_changelog():
+  """
+  Returns the change log written by documents in "changelog" indexer mode.
+  """
+  global _changelog
+  if _changelog is None:
+    config = getattr(settings, "ITSY_SEARCH_CHANGELOG", None) or {}
+    _changelog = ChangeLogSource(**config)
+
+  return _changelog
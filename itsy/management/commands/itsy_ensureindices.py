@@ -0,0 +1,15 @@
+from django.core.management import base as management_base
+
+from ... import registry as itsy_registry
+
+class Command(management_base.BaseCommand):
+  help = "Creates database indices for all registered documents."
+  requires_model_validation = True
+
+  def handle(self, *args, **options):
+    """
+    Creates database indices for all registered documents.
+    """
+    for document_cls in itsy_registry.document_registry:
+      self.stdout.write("Ensuring indices for %s...\n" % document_cls.__name__)
+      document_cls._meta.ensure_indices()
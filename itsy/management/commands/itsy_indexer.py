@@ -0,0 +1,43 @@
+import optparse
+
+from django.core.management import base as management_base
+
+from ... import indexer as itsy_indexer
+
+class Command(management_base.BaseCommand):
+  help = "Runs the search indexer daemon that applies recorded document changes."
+  requires_model_validation = True
+  option_list = management_base.BaseCommand.option_list + (
+    optparse.make_option('--source', dest = 'source', default = None,
+      help = "Change source to consume (changelog or oplog); defaults to ITSY_SEARCH_INDEXER."),
+
+    optparse.make_option('--name', dest = 'name', default = "default",
+      help = "Indexer name under which the resume position is stored."),
+
+    optparse.make_option('--batch-size', dest = 'batch-size', type = 'int', default = 500,
+      help = "Maximum number of changes applied in a single batch."),
+  )
+
+  def handle(self, *args, **options):
+    """
+    Runs the search indexer daemon.
+    """
+    source_name = options.get("source") or itsy_indexer.indexer_mode()
+    if source_name == "changelog":
+      source = itsy_indexer.get_changelog()
+    elif source_name == "oplog":
+      source = itsy_indexer.OplogSource()
+    else:
+      raise management_base.CommandError("Indexer source must be either changelog or oplog!")
+
+    indexer = itsy_indexer.SearchIndexer(
+      source,
+      name = options.get("name"),
+      batch_size = options.get("batch-size"),
+    )
+
+    self.stdout.write("Indexing changes from %s, resuming at %s...\n" % (source_name, indexer.position))
+    try:
+      indexer.run()
+    except KeyboardInterrupt:
+      self.stdout.write("Indexer stopped at %s.\n" % indexer.position)
@@ -0,0 +1,57 @@
+import optparse
+
+from django.core.management import base as management_base
+
+from ... import outbox as itsy_outbox
+
+class Command(management_base.BaseCommand):
+  help = "Drains post-save tasks recorded in the task outbox."
+  requires_model_validation = True
+  option_list = management_base.BaseCommand.option_list + (
+    optparse.make_option('--batch-size', dest = 'batch-size', type = 'int', default = 500,
+      help = "Maximum number of tasks claimed at once."),
+
+    optparse.make_option('--claim-timeout', dest = 'claim-timeout', type = 'int', default = 300,
+      help = "Number of seconds after which claimed tasks may be claimed again."),
+
+    optparse.make_option('--max-attempts', dest = 'max-attempts', type = 'int', default = 5,
+      help = "Number of attempts after which failing tasks are moved into the dead letter collection."),
+
+    optparse.make_option('--once', action = 'store_true', dest = 'once', default = False,
+      help = "Drain the outbox until it is empty and exit."),
+
+    optparse.make_option('--stats', action = 'store_true', dest = 'stats', default = False,
+      help = "Only report outbox backlog, lag and dead letters."),
+  )
+
+  def handle(self, *args, **options):
+    """
+    Drains post-save tasks recorded in the task outbox.
+    """
+    drainer = itsy_outbox.OutboxDrainer(
+      batch_size = options.get("batch-size"),
+      claim_timeout = options.get("claim-timeout"),
+      max_attempts = options.get("max-attempts"),
+    )
+
+    if options.get("stats"):
+      stats = drainer.publish_stats()
+      self.stdout.write("Outbox backlog: %d tasks, lag: %.1f seconds, dead letters: %d.\n" % (
+        stats['backlog'], stats['lag'], stats['dead_letters']))
+      return
+
+    if options.get("once"):
+      executed = 0
+      while True:
+        count = drainer.drain_once()
+        if not count:
+          break
+        executed += count
+      self.stdout.write("Executed %d tasks.\n" % executed)
+      return
+
+    self.stdout.write("Draining task outbox...\n")
+    try:
+      drainer.run()
+    except KeyboardInterrupt:
+      self.stdout.write("Outbox drainer stopped.\n")
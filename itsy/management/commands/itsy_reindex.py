@@ -1,11 +1,14 @@
+import datetime
 import optparse
-import traceback
 
 from django.core.management import base as management_base
 from django.utils import importlib
 
 from ... import document as itsy_document
 from ... import tasks as itsy_tasks
+from ...search import reindex as itsy_reindex
+from ...search import throttle as itsy_throttle
+from ...search import verify as itsy_verify
 
 class Command(management_base.BaseCommand):
   args = "class_path"
@@ -19,7 +22,31 @@ class Command(management_base.BaseCommand):
       help = "Should the index be dropped and recreated. THIS WILL ERASE ALL DATA!"),
 
     optparse.make_option('--start-pk', dest = 'start-pk', default = "0",
-      help = "Start with the specified primary key instead of the first one.")
+      help = "Start with the specified primary key instead of the first one."),
+
+    optparse.make_option('--bulk-size', dest = 'bulk-size', type = 'int', default = 500,
+      help = "Number of documents sent in a single bulk request."),
+
+    optparse.make_option('--workers', dest = 'workers', type = 'int', default = 1,
+      help = "Number of threads preparing documents for indexing."),
+
+    optparse.make_option('--processes', dest = 'processes', type = 'int', default = 0,
+      help = "Number of processes preparing documents for indexing."),
+
+    optparse.make_option('--max-rate', dest = 'max-rate', type = 'float', default = None,
+      help = "Maximum number of documents indexed per second."),
+
+    optparse.make_option('--verify', action = 'store_true', dest = 'verify', default = False,
+      help = "Only reindex documents that are missing or outdated in the index and remove orphaned entries."),
+
+    optparse.make_option('--since', dest = 'since', default = None,
+      help = "Only verify documents updated since the given UTC time (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS)."),
+
+    optparse.make_option('--pause', action = 'store_true', dest = 'pause', default = False,
+      help = "Pause running reindex operations of the given document class."),
+
+    optparse.make_option('--resume', action = 'store_true', dest = 'resume', default = False,
+      help = "Resume paused reindex operations of the given document class.")
   )
 
   def handle(self, *args, **options):
@@ -42,6 +69,30 @@ class Command(management_base.BaseCommand):
     if not document_class._meta.searchable or document_class._meta.abstract or document_class._meta.embedded:
       raise management_base.CommandError("Specified document is not searchable!")
 
+    if options.get("pause"):
+      itsy_throttle.pause(document_class)
+      self.stdout.write("Reindex of %s has been paused.\n" % class_path)
+      return
+    elif options.get("resume"):
+      itsy_throttle.resume(document_class)
+      self.stdout.write("Reindex of %s has been resumed.\n" % class_path)
+      return
+
+    since = None
+    if options.get("since"):
+      for time_format in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+          since = datetime.datetime.strptime(options.get("since"), time_format)
+          break
+        except ValueError:
+          continue
+      else:
+        raise management_base.CommandError("Invalid time specified for --since!")
+
+      # Only revisable documents record the time of their last update
+      if not document_class._meta.revisable:
+        raise management_base.CommandError("Option --since may only be used for revisable documents!")
+
     if options.get("recreate-index"):
       # Drop the index and recreate it
       self.stdout.write("Recreating index...\n")
@@ -50,7 +101,12 @@ class Command(management_base.BaseCommand):
 
     if options.get("background"):
       # Spawn the reindex task
-      itsy_tasks.search_index_reindex.delay(document_class)
+      itsy_tasks.search_index_reindex_pipeline.delay(
+        document_class,
+        max_rate = options.get("max-rate"),
+        verify = options.get("verify"),
+        since = since,
+      )
 
       # Notify the user that the reindex has started in the background
       self.stdout.write("Reindex of %s has been initiated in the background.\n" % class_path)
@@ -62,36 +118,48 @@ class Command(management_base.BaseCommand):
         "index" : { "refresh_interval" : "-1" } })
 
       # Setup the primary key offset
-      last_pk = int(options.get("start-pk", "0"))
+      start_pk = int(options.get("start-pk", "0"))
+
+      def progress(pipeline):
+        self.stdout.write("Indexed %d documents (%d failed), resumable at pk=%s.\n" % (
+          pipeline.indexed, pipeline.failed, pipeline.last_pk))
+
+      def error(pk, message):
+        # Print the error and continue reindexing
+        self.stderr.write("ERROR: Failed to index pk=%s:\n%s\n" % (pk, message))
+
+      # A throttle is always installed, so that the reindex may be paused
+      if options.get("max-rate"):
+        throttle = itsy_throttle.AdaptiveThrottle(document_class, { "max_rate" : options.get("max-rate") })
+      else:
+        throttle = itsy_throttle.AdaptiveThrottle(document_class, { "initial_rate" : None })
+
+      pipeline = itsy_reindex.ReindexPipeline(
+        document_class,
+        bulk_size = options.get("bulk-size"),
+        workers = options.get("workers"),
+        processes = options.get("processes"),
+        throttle = throttle,
+        on_progress = progress,
+        on_error = error,
+      )
 
       try:
-        num_indexed = 0
-        batch_size = 10000
-        while True:
+        if options.get("verify") or since is not None:
+          verifier = itsy_verify.reindex_stale(pipeline, since = since)
+          self.stdout.write("Verified index: %d missing, %d outdated, %d orphaned.\n" % (
+            verifier.missing, verifier.outdated, verifier.orphaned))
+        else:
           # Assume that primary keys are monotonically incrementing
-          self.stdout.write("Starting batch %d at pk=%s.\n" % (num_indexed // batch_size + 1, last_pk))
-          old_last_pk = last_pk
-          for document in document_class.find(pk__gt = last_pk).order_by("pk").limit(batch_size):
-            try:
-              document.save(target = itsy_document.DocumentSource.Search)
-            except KeyboardInterrupt:
-              self.stdout.write("ERROR: Aborted by user.\n")
-              raise
-            except:
-              # Print the exception and continue reindexing
-              traceback.print_exc()
-
-            last_pk = document.pk
-            num_indexed += 1
-            if num_indexed % 100 == 0:
-              self.stdout.write("Indexed %d documents.\n" % num_indexed)
-
-          if old_last_pk == last_pk:
-            self.stdout.write("Index finished at pk=%s.\n" % last_pk)
-            break
+          pipeline.run(document_class.find(pk__gt = start_pk).read_preference("PRIMARY").defer(None).order_by("pk"))
+          self.stdout.write("Index finished at pk=%s.\n" % pipeline.last_pk)
       except KeyboardInterrupt:
-        self.stdout.write("Index aborted at pk=%s.\n" % last_pk)
+        self.stdout.write("Index aborted at pk=%s.\n" % pipeline.last_pk)
       finally:
+        for name, stats in sorted(pipeline.stats().iteritems()):
+          self.stdout.write("Stage %s: %d documents, %.1f documents/s, queue depth %.1f (max %d).\n" % (
+            name, stats['documents'], stats['throughput'], stats['queue_depth'], stats['queue_depth_max']))
+
         # Restore index configuration after indexing
         document_class._meta.search_engine.set_configuration({
           "index" : { "refresh_interval" : "1s" } })
@@ -1,3 +1,5 @@
+import optparse
+
 from django.core.management import base as management_base
 
 from ... import registry as itsy_registry
@@ -5,12 +7,21 @@ from ... import registry as itsy_registry
 class Command(management_base.BaseCommand):
   help = "Performs a search type mapping synchronization."
   requires_model_validation = True
+  option_list = management_base.BaseCommand.option_list + (
+    optparse.make_option('--dry-run', action = 'store_true', dest = 'dry-run', default = False,
+      help = "Only report what would change without modifying the indices."),
+  )
 
   def handle(self, *args, **options):
     """
     Performs a search type mapping synchronization.
     """
+    dry_run = options.get("dry-run")
     for document_cls in itsy_registry.document_registry:
       if document_cls._meta.searchable:
         self.stdout.write("Syncing search type mapping for %s...\n" % document_cls.__name__)
-        document_cls._meta.emit_search_mappings()
+        changes = document_cls._meta.emit_search_mappings(dry_run = dry_run)
+        for change in changes:
+          self.stdout.write("  %s%s\n" % ("would " if dry_run else "", change))
+        if not changes:
+          self.stdout.write("  up to date\n")
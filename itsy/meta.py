@@ -141,8 +141,10 @@ class DocumentMetadata(FieldMetadata):
       self.classname = metadata['classname']
       self.searchable = metadata.get('searchable', True)
       self.revisable = metadata.get('revisable', True)
+      self.deferred_fields = metadata.get('deferred_fields', [])
     else:
       self.abstract = False
+      self.deferred_fields = []
 
     self.field_list = []
     self.reverse_references = []
@@ -158,7 +160,16 @@ class DocumentMetadata(FieldMetadata):
 
   def setup_indices(self):
     """
-    Sets up the document indices.
+    Sets up the document indices. Indices are created immediately only when
+    ITSY_ENSURE_INDICES_ON_IMPORT is set, otherwise `ensure_indices` must be
+    called (for example by the itsy_ensureindices management command).
+    """
+    if getattr(settings, "ITSY_ENSURE_INDICES_ON_IMPORT", False):
+      self.ensure_indices()
+
+  def ensure_indices(self):
+    """
+    Creates the document indices in the database.
     """
     if self.abstract or self.embedded:
       return
@@ -234,12 +245,12 @@ class DocumentMetadata(FieldMetadata):
         mappings[name] = obj.get_search_mapping()
     return mappings
 
-  def emit_search_mappings(self):
+  def get_search_configuration(self):
     """
-    Emits the search mappings.
+    Returns the search index configuration and type mapping.
+
+    @return: A tuple (config, mapping)
     """
-    if not self.searchable or self.abstract or self.embedded:
-      return
 
     # Prepare mappings according to our document's fields
     mapping = self.search_mapping_prepare()
@@ -259,18 +270,31 @@ class DocumentMetadata(FieldMetadata):
     # Get default configuration options
     default_config = getattr(settings, "ITSY_ELASTICSEARCH_DEFAULT_CONFIG", {})
 
-    self.search_engine.set_configuration(dict(
+    config = dict(
       analysis = dict(
         analyzer = analyzers,
         tokenizer = tokenizers,
         filter = filters
       ),
-      index = default_config.get("index", {})
-    ), create = True)
+      index = dict(default_config.get("index", {}))
+    )
 
-    # Send mappings to our search engine instance
-    self.search_engine.set_mapping(dict(
+    return config, dict(
       dynamic = "strict",
       properties = mapping
-    ))
+    )
+
+  def emit_search_mappings(self, dry_run = False):
+    """
+    Emits the search mappings, only applying changes to the current index
+    configuration.
+
+    @param dry_run: Only report changes without applying them
+    @return: A list of change descriptions
+    """
+    if not self.searchable or self.abstract or self.embedded:
+      return []
+
+    config, mapping = self.get_search_configuration()
+    return self.search_engine.sync_configuration(config, mapping, dry_run = dry_run)
 
@@ -0,0 +1,57 @@
+import threading
+
+class MetricsRegistry(object):
+  """
+  A simple thread-safe registry of named counters.
+  """
+  def __init__(self):
+    """
+    Class constructor.
+    """
+    self._counters = {}
+    self._lock = threading.Lock()
+
+  def increment(self, name, value = 1):
+    """
+    Increments a counter.
+
+    @param name: Counter name
+    @param value: Increment
+    """
+    with self._lock:
+      self._counters[name] = self._counters.get(name, 0) + value
+
+  def set(self, name, value):
+    """
+    Sets a counter to an absolute value, so that it may be used as a gauge.
+
+    @param name: Counter name
+    @param value: Value
+    """
+    with self._lock:
+      self._counters[name] = value
+
+  def get(self, name):
+    """
+    Returns the current value of a counter.
+
+    @param name: Counter name
+    """
+    with self._lock:
+      return self._counters.get(name, 0)
+
+  def snapshot(self):
+    """
+    Returns a copy of all counters.
+    """
+    with self._lock:
+      return dict(self._counters)
+
+  def reset(self):
+    """
+    Resets all counters.
+    """
+    with self._lock:
+      self._counters.clear()
+
+metrics = MetricsRegistry()
@@ -0,0 +1,476 @@
+from __future__ import absolute_import
+
+import collections
+import datetime
+import threading
+import time
+import uuid
+
+import pymongo
+from django.conf import settings
+
+from . import indexer, registry
+from . import tasks as common_tasks
+from .connection import store
+from .metrics import metrics
+
+# Tasks that may be recorded in the outbox
+SEARCH_UPDATE = "search_index_update"
+SEARCH_REMOVE = "search_index_remove"
+CACHE_SYNC = "cache_spawn_syncers"
+
+# Document field holding tasks recorded when the document was saved
+OUTBOX_FIELD = "_outbox"
+
+# Prefix of document fields holding the claim of recorded tasks
+CLAIM_PREFIX = "_outbox_"
+
+def outbox_enabled():
+  """
+  Returns True when post-save tasks should be recorded in the outbox
+  instead of being sent to the broker.
+  """
+  return bool(getattr(settings, "ITSY_TASK_OUTBOX", False))
+
+def recorded_tasks(tasks):
+  """
+  Returns those of the given post-save tasks that are recorded on the saved
+  documents instead of being dispatched. Search index updates are only
+  recorded when indices are updated by tasks.
+
+  @param tasks: A list of task names
+  """
+  if not outbox_enabled():
+    return []
+
+  return [
+    task for task in tasks
+    if task == CACHE_SYNC or (task == SEARCH_UPDATE and indexer.indexer_mode() == "tasks")
+  ]
+
+def make_entries(tasks, modified_fields):
+  """
+  Returns entries that record the given tasks in the outbox field of a
+  document. They must be written by the same update as the document itself.
+
+  @param tasks: A list of task names
+  @param modified_fields: Fields that have been modified (None when unknown)
+  """
+  now = datetime.datetime.utcnow()
+  fields = list(modified_fields) if modified_fields is not None else None
+  return [{ "id" : uuid.uuid4().hex, "t" : task, "f" : fields, "created" : now } for task in tasks]
+
+def dispatch_cache_sync(doc_class, pks, modified_fields):
+  """
+  Requests resync of cached references to the given documents.
+
+  @param doc_class: Document class
+  @param pks: A list of primary keys
+  @param modified_fields: Fields that have been modified (None when unknown)
+  """
+  if outbox_enabled():
+    get_outbox().append(CACHE_SYNC, doc_class, pks, modified_fields)
+  elif len(pks) == 1:
+    common_tasks.cache_spawn_syncers.delay(doc_class, pks[0], modified_fields)
+  else:
+    common_tasks.cache_spawn_syncers_batch.delay(doc_class, pks, modified_fields)
+
+class Claim(object):
+  """
+  Tasks of a single document claimed from the outbox.
+  """
+  def __init__(self, collection, owner, record_id, doc_class, pk, entries, attempts):
+    """
+    Class constructor.
+
+    @param collection: Collection holding the tasks
+    @param owner: Claim owner
+    @param record_id: Identifier of the record or document holding the tasks
+    @param doc_class: Document class
+    @param pk: Primary key (formatted for the database)
+    @param entries: A list of recorded tasks
+    @param attempts: Number of times the tasks have been claimed
+    """
+    self.collection = collection
+    self.owner = owner
+    self.record_id = record_id
+    self.doc_class = doc_class
+    self.pk = pk
+    self.entries = entries
+    self.attempts = attempts
+
+class Outbox(object):
+  """
+  Post-save tasks are recorded on the saved documents themselves, in an
+  array written by the same update as the document, so that they cannot be
+  lost. Removals and tasks dispatched outside of saves are recorded in a
+  MongoDB collection; removals are recorded before documents are deleted
+  and only executed after `remove_delay` seconds. Recorded tasks are
+  claimed in batches and executed by an OutboxDrainer.
+  """
+  def __init__(self, name = "itsy.outbox", remove_delay = 10):
+    """
+    Class constructor.
+
+    @param name: Collection name
+    @param remove_delay: Number of seconds after which recorded removals are executed
+    """
+    self.collection = store.collection(name)
+    self.dead_letters = store.collection("{0}.dead".format(name))
+    self.remove_delay = remove_delay
+    self._indexed = set()
+
+  def _ensure_index(self, collection, key, **kwargs):
+    """
+    Creates an index used when claiming tasks.
+    """
+    if (collection.name, key) not in self._indexed:
+      collection.ensure_index([(key, pymongo.ASCENDING)], **kwargs)
+      self._indexed.add((collection.name, key))
+
+  def _document_classes(self):
+    """
+    Returns a list of document classes that may hold recorded tasks.
+    """
+    return [
+      cls for cls in registry.document_registry
+      if not cls._meta.abstract and not cls._meta.embedded
+    ]
+
+  def append(self, task, doc_class, pks, modified_fields = None, versions = None):
+    """
+    Records a task for each of the given documents in the outbox collection.
+
+    @param task: Task name
+    @param doc_class: Document class
+    @param pks: A list of primary keys (stored in the database format)
+    @param modified_fields: Fields that have been modified (None when unknown)
+    @param versions: Optional list of last versions of deleted documents
+    """
+    now = datetime.datetime.utcnow()
+    pks = indexer._db_pks(doc_class, pks)
+    fields = list(modified_fields) if modified_fields is not None else None
+    if versions is None:
+      versions = [None] * len(pks)
+
+    self.collection.insert([
+      {
+        "t" : task,
+        "c" : indexer._class_key(doc_class),
+        "k" : pk,
+        "f" : fields,
+        "v" : version,
+        "created" : now,
+        "claimed_until" : None,
+      }
+      for pk, version in zip(pks, versions)
+    ], safe = True)
+
+  def _claim(self, collection, spec, prefix, limit, claim_timeout, fields = None):
+    """
+    Claims records matching the given specification that are not claimed by
+    another drainer or whose claims have expired, counting claim attempts.
+
+    @return: A tuple (owner, records)
+    """
+    now = datetime.datetime.utcnow()
+    spec = dict(spec)
+    spec["$or"] = [{ prefix + "claimed_until" : None }, { prefix + "claimed_until" : { "$lt" : now } }]
+    candidates = [record["_id"] for record in collection.find(spec, fields = ["_id"]).limit(limit)]
+    if not candidates:
+      return None, []
+
+    # Records claimed concurrently by another drainer are not updated
+    owner = uuid.uuid4().hex
+    spec["_id"] = { "$in" : candidates }
+    collection.update(
+      spec,
+      {
+        "$set" : {
+          prefix + "owner" : owner,
+          prefix + "claimed_until" : now + datetime.timedelta(seconds = claim_timeout),
+        },
+        "$inc" : { prefix + "attempts" : 1 },
+      },
+      multi = True,
+      safe = True
+    )
+
+    return owner, list(collection.find({ "_id" : { "$in" : candidates }, prefix + "owner" : owner }, fields = fields))
+
+  def claim(self, limit, claim_timeout):
+    """
+    Claims a batch of recorded tasks.
+
+    @param limit: Maximum number of records and documents
+    @param claim_timeout: Number of seconds after which claims expire
+    @return: A list of Claim instances
+    """
+    classes = self._document_classes()
+    class_keys = dict((indexer._class_key(cls), cls) for cls in classes)
+    claims = []
+
+    # Tasks recorded in the outbox collection
+    self._ensure_index(self.collection, "claimed_until")
+    delayed = datetime.datetime.utcnow() - datetime.timedelta(seconds = self.remove_delay)
+    owner, records = self._claim(
+      self.collection,
+      { "$nor" : [{ "t" : SEARCH_REMOVE, "created" : { "$gt" : delayed } }] },
+      "",
+      limit,
+      claim_timeout
+    )
+    for record in records:
+      doc_class = class_keys.get(record["c"])
+      if doc_class is not None:
+        claims.append(Claim(
+          self.collection, owner, record["_id"], doc_class, record["k"], [record], record.get("attempts", 1)
+        ))
+
+    # Tasks recorded on documents
+    key = "{0}.created".format(OUTBOX_FIELD)
+    for doc_class in classes:
+      if len(claims) >= limit:
+        break
+
+      collection = doc_class._meta.collection
+      self._ensure_index(collection, key, sparse = True)
+      owner, documents = self._claim(
+        collection,
+        { key : { "$lte" : datetime.datetime.utcnow() } },
+        CLAIM_PREFIX,
+        limit - len(claims),
+        claim_timeout,
+        fields = [OUTBOX_FIELD, CLAIM_PREFIX + "attempts"]
+      )
+      for document in documents:
+        claims.append(Claim(
+          collection, owner, document["_id"], doc_class, document["_id"],
+          document.get(OUTBOX_FIELD) or [], document.get(CLAIM_PREFIX + "attempts", 1)
+        ))
+
+    return claims
+
+  def complete(self, claims):
+    """
+    Removes executed tasks. Tasks recorded on documents after they have been
+    claimed are kept.
+
+    @param claims: A list of Claim instances
+    """
+    groups = collections.OrderedDict()
+    for claim in claims:
+      groups.setdefault((claim.collection, claim.owner), []).append(claim)
+
+    for (collection, owner), group in groups.iteritems():
+      ids = [claim.record_id for claim in group]
+      if collection is self.collection:
+        collection.remove({ "_id" : { "$in" : ids } }, safe = True)
+        continue
+
+      collection.update(
+        { "_id" : { "$in" : ids }, CLAIM_PREFIX + "owner" : owner },
+        {
+          "$pull" : { OUTBOX_FIELD : { "id" : { "$in" : [entry["id"] for claim in group for entry in claim.entries] } } },
+          "$unset" : dict((CLAIM_PREFIX + name, 1) for name in ("owner", "claimed_until", "attempts")),
+        },
+        multi = True,
+        safe = True
+      )
+      collection.update(
+        { "_id" : { "$in" : ids }, OUTBOX_FIELD : { "$size" : 0 } },
+        { "$unset" : { OUTBOX_FIELD : 1 } },
+        multi = True,
+        safe = True
+      )
+
+  def dead_letter(self, claims):
+    """
+    Moves tasks that keep failing into the dead letter collection.
+
+    @param claims: A list of Claim instances
+    """
+    now = datetime.datetime.utcnow()
+    self.dead_letters.insert([
+      {
+        "t" : entry["t"],
+        "c" : indexer._class_key(claim.doc_class),
+        "k" : claim.pk,
+        "f" : entry["f"],
+        "v" : entry.get("v"),
+        "created" : entry["created"],
+        "failed" : now,
+        "attempts" : claim.attempts,
+      }
+      for claim in claims
+      for entry in claim.entries
+    ], safe = True)
+    self.complete(claims)
+
+  def stats(self):
+    """
+    Returns the number of records and documents holding recorded tasks
+    (backlog), the age of the oldest task in seconds (lag) and the number of
+    dead letters.
+    """
+    backlog = self.collection.count()
+    oldest = []
+    for record in self.collection.find(fields = ["created"]).sort("created", pymongo.ASCENDING).limit(1):
+      oldest.append(record["created"])
+
+    key = "{0}.created".format(OUTBOX_FIELD)
+    spec = { key : { "$lte" : datetime.datetime.utcnow() } }
+    for doc_class in self._document_classes():
+      collection = doc_class._meta.collection
+      backlog += collection.find(spec).count()
+      for document in collection.find(spec, fields = [key]).sort(key, pymongo.ASCENDING).limit(1):
+        oldest.append(min(entry["created"] for entry in document[OUTBOX_FIELD]))
+
+    lag = 0.0
+    if oldest:
+      lag = max(0.0, (datetime.datetime.utcnow() - min(oldest)).total_seconds())
+
+    return dict(backlog = backlog, lag = lag, dead_letters = self.dead_letters.count())
+
+class OutboxDrainer(object):
+  """
+  Executes tasks recorded in the outbox. Claimed tasks are deduplicated
+  by (class, pk, task) and executed in bulk; tasks are only removed after
+  they have been executed, so failed tasks are retried once their claims
+  expire. Tasks claimed more than `max_attempts` times are moved into the
+  dead letter collection.
+  """
+  def __init__(self, outbox = None, batch_size = 500, claim_timeout = 300, timeout = 1.0, max_attempts = 5):
+    """
+    Class constructor.
+
+    @param outbox: Outbox to drain (defaults to the configured outbox)
+    @param batch_size: Maximum number of records and documents claimed at once
+    @param claim_timeout: Number of seconds after which claims expire
+    @param timeout: Time to wait when the outbox is empty
+    @param max_attempts: Number of attempts after which tasks are dead-lettered
+    """
+    self.outbox = outbox if outbox is not None else get_outbox()
+    self.batch_size = batch_size
+    self.claim_timeout = claim_timeout
+    self.timeout = timeout
+    self.max_attempts = max_attempts
+    self._stopped = threading.Event()
+
+  def execute(self, claims):
+    """
+    Executes claimed tasks.
+
+    @param claims: A list of Claim instances
+    """
+    # Deduplicate tasks, merging modified fields of cache resyncs and keeping
+    # the last versions of deleted documents
+    tasks = collections.OrderedDict()
+    versions = {}
+    count = 0
+    for claim in claims:
+      pk = indexer._db_pks(claim.doc_class, [claim.pk])[0]
+      for entry in claim.entries:
+        count += 1
+        if entry.get("v") is not None:
+          versions[(claim.doc_class, pk)] = max(entry["v"], versions.get((claim.doc_class, pk)))
+        key = (claim.doc_class, pk, entry["t"])
+        if key not in tasks:
+          tasks[key] = set(entry["f"]) if entry["f"] is not None else None
+        elif tasks[key] is not None:
+          if entry["f"] is None:
+            tasks[key] = None
+          else:
+            tasks[key].update(entry["f"])
+
+    metrics.increment("outbox.duplicates", count - len(tasks))
+
+    changes = []
+    for (doc_class, pk, task), fields in tasks.iteritems():
+      if task in (SEARCH_UPDATE, SEARCH_REMOVE):
+        # Documents that no longer exist are removed from the index, while
+        # documents whose deletion has failed after recording are reindexed
+        changes.append(indexer.Change(None, doc_class, indexer.UPDATE, pk, versions.get((doc_class, pk))))
+      elif task == CACHE_SYNC:
+        common_tasks.cache_spawn_syncers(doc_class, pk, fields)
+
+    if changes:
+      indexer.apply_changes(changes)
+
+  def drain_once(self):
+    """
+    Claims and executes a single batch of recorded tasks. When the batch
+    fails, tasks of each record or document are executed separately, so
+    that failing tasks do not hold back the others.
+
+    @return: Number of claimed records and documents
+    """
+    claims = self.outbox.claim(self.batch_size, self.claim_timeout)
+    if not claims:
+      return 0
+
+    dead = [claim for claim in claims if claim.attempts > self.max_attempts]
+    if dead:
+      self.outbox.dead_letter(dead)
+      metrics.increment("outbox.dead_letters", len(dead))
+
+    pending = [claim for claim in claims if claim.attempts <= self.max_attempts]
+    try:
+      self.execute(pending)
+      executed = pending
+    except Exception:
+      executed = []
+      for claim in pending:
+        try:
+          self.execute([claim])
+          executed.append(claim)
+        except Exception:
+          metrics.increment("outbox.errors")
+
+    self.outbox.complete(executed)
+    metrics.increment("outbox.processed", len(executed))
+    return len(claims)
+
+  def publish_stats(self):
+    """
+    Publishes outbox backlog, lag and dead letters to the metrics registry.
+    """
+    stats = self.outbox.stats()
+    metrics.set("outbox.backlog", stats['backlog'])
+    metrics.set("outbox.lag", stats['lag'])
+    metrics.set("outbox.dead_letters", stats['dead_letters'])
+    return stats
+
+  def run(self):
+    """
+    Drains the outbox until stopped. Failed tasks are retried after their
+    claims expire.
+    """
+    while not self._stopped.is_set():
+      try:
+        claimed = self.drain_once()
+        self.publish_stats()
+        if not claimed:
+          time.sleep(self.timeout)
+      except Exception:
+        metrics.increment("outbox.errors")
+        time.sleep(self.timeout)
+
+  def stop(self):
+    """
+    Requests the drainer to stop after the current batch.
+    """
+    self._stopped.set()
+
+_outbox = None
+
+def get_outbox():
+  """
+  Returns the configured outbox.
+  """
+  global _outbox
+  if _outbox is None:
+    config = getattr(settings, "ITSY_TASK_OUTBOX", None)
+    _outbox = Outbox(**config) if isinstance(config, dict) else Outbox()
+
+  return _outbox
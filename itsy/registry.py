@@ -9,4 +9,8 @@ class DocumentRegistry(object):
   def __iter__(self):
     return iter(self._documents)
 
+  def ensure_indices(self):
+    for cls in self._documents:
+      cls._meta.ensure_indices()
+
 document_registry = DocumentRegistry()
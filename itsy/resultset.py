@@ -1,6 +1,29 @@
 from __future__ import absolute_import
 
+import collections
+import datetime
+import threading
+import time
+import uuid
+
 import pymongo
+import pyes.exceptions
+
+from . import concurrency, exceptions, indexer, outbox
+from . import tasks as common_tasks
+from .connection import search_cache, store
+from .store import set_read_preference
+
+# Number of documents processed per server-side operation and per dispatched
+# background task when performing bulk updates and deletes
+BULK_CHUNK_SIZE = 500
+
+# Number of times bulk updates retry documents whose editorial mutex is held
+# by someone else, waiting a second between attempts
+BULK_LOCK_RETRIES = 5
+
+# Maximum number of pages kept in a search result set's page cache
+SEARCH_PAGE_CACHE_SIZE = 5
 
 class DbResultSet(object):
   """
@@ -9,6 +32,8 @@ class DbResultSet(object):
   _has_limit = False
   _has_skip = False
   _only_fields = None
+  _defer_fields = None
+  _unloaded = None
   
   def __init__(self, document, spec, cursor = None):
     """
@@ -20,6 +45,7 @@ class DbResultSet(object):
     """
     self.document = document
     self._only_fields = set()
+    self._defer_fields = set()
     
     if cursor is not None:
       self.spec = spec
@@ -27,6 +53,10 @@ class DbResultSet(object):
     else:
       self.spec = self._parse_spec(spec)
       self.query = document._meta.collection.find(self.spec)
+      if document._meta.deferred_fields:
+        self.defer(*document._meta.deferred_fields)
+      if store.read_preference is not None:
+        self.read_preference(store.read_preference)
   
   def _parse_spec(self, spec):
     """
@@ -44,7 +74,10 @@ class DbResultSet(object):
       field_spec, last_field = self.document._meta.resolve_subfield_hierarchy(elements, get_field = True)
       if last_field is not None:
         # TODO value should be properly prepared
-        value = last_field.to_query(value)
+        if op in ('in', 'nin', 'all'):
+          value = [last_field.to_query(x) for x in value]
+        elif op not in ('mod', 'size', 'exists'):
+          value = last_field.to_query(value)
 
       # TODO 
 
@@ -78,6 +111,19 @@ class DbResultSet(object):
     self._has_skip = True
     return self
   
+  def read_preference(self, preference):
+    """
+    Routes reads of this result set according to the given read preference,
+    for example to send listing queries to secondaries. The default is given
+    by the read_preference connection option. Writes, document locking,
+    refreshes, `Document.get` and internal reads (indexing, reference
+    checks) always use the primary.
+
+    @param preference: A pymongo.ReadPreference value or its name
+    """
+    set_read_preference(self.query, preference)
+    return self
+
   def count(self):
     """
     Returns the number of documents returned by this query.
@@ -115,10 +161,12 @@ class DbResultSet(object):
     """
     Clones this result set and returns it.
     """
-    rs = DbResultSet(self.model, self.spec, self.query.clone())
+    rs = DbResultSet(self.document, self.spec, self.query.clone())
     rs._has_limit = self._has_limit
     rs._has_skip = self._has_skip
-    rs._only_fields = self._only_fields
+    rs._only_fields = set(self._only_fields)
+    rs._defer_fields = set(self._defer_fields)
+    rs._update_projection()
     return rs
   
   def one(self):
@@ -135,22 +183,408 @@ class DbResultSet(object):
     Selects a subset of fields to be fetched.
     """
     for field in fields:
-      path = ".".join(self.document._meta.resolve_subfield_hierarchy(field.split(".")))
-      self._only_fields.add(path)
-      if self.query._Cursor__fields is None:
-        # Identifier and version fields must always be included
-        self.query._Cursor__fields = { "_id" : 1, "_version" : 1 }
+      self._only_fields.add(self._resolve_db_path(field))
+
+    self._update_projection()
+    return self
 
-      self.query._Cursor__fields.update({ path : 1 })
+  def defer(self, *fields):
+    """
+    Defers loading of some fields. Deferred fields are transparently fetched
+    using a single query when any of them is first accessed on a document.
+    Passing None clears all deferred fields, including the ones configured
+    via `deferred_fields` metadata.
+    """
+    if fields == (None,):
+      self._defer_fields.clear()
+    else:
+      for field in fields:
+        self._defer_fields.add(self._resolve_db_path(field))
 
+    self._update_projection()
     return self
 
+  def _update_projection(self):
+    """
+    Updates the cursor's field projection to match the fields selected via
+    `only` and `defer`.
+    """
+    if self._only_fields:
+      # Identifier and version fields must always be included
+      projection = { "_id" : 1, "_version" : 1 }
+      for path in self._only_fields:
+        if path not in self._defer_fields:
+          projection[path] = 1
+    elif self._defer_fields:
+      projection = dict((path, 0) for path in self._defer_fields)
+    else:
+      projection = None
+
+    self.query._Cursor__fields = projection
+    self._unloaded = None
+
+  def _unloaded_fields(self):
+    """
+    Returns a tuple of sets containing top-level fields that will be missing
+    (deferred) and fields that will only be partially loaded from the database.
+    """
+    deferred, partial = set(), set()
+    if not self._only_fields and not self._defer_fields:
+      return deferred, partial
+
+    meta = self.document._meta
+    for field in meta.db_fields.values():
+      if field.virtual or field is meta.get_primary_key_field():
+        continue
+
+      subpath = "{0}.".format(field.db_name)
+      if self._only_fields:
+        included = field.db_name in self._only_fields and field.db_name not in self._defer_fields
+        if not included:
+          if any(path.startswith(subpath) for path in self._only_fields):
+            partial.add(field)
+          else:
+            deferred.add(field)
+      elif field.db_name in self._defer_fields:
+        deferred.add(field)
+      elif any(path.startswith(subpath) for path in self._defer_fields):
+        partial.add(field)
+
+    return deferred, partial
+
+  def _id_cursor(self):
+    """
+    Returns a clone of this result set's cursor (honoring limit, skip and sort
+    order) that only fetches identifiers, so the query may be covered by an
+    index.
+    """
+    cursor = self.query.clone()
+    cursor._Cursor__fields = { "_id" : 1 }
+    return cursor
+
   def ids(self):
     """
     Limits the result to only return identifiers instead of documents.
     """
-    return (x["_id"] for x in self.document._meta.collection.find(self.spec, fields = ("_id",)))
+    return (x["_id"] for x in self._id_cursor())
+
+  def versions(self, no_timeout = False, search = False):
+    """
+    Returns (identifier, version) pairs instead of documents.
+
+    @param no_timeout: Should the server-side cursor timeout be disabled
+    @param search: Should versions of the last modifications affecting the search index be returned
+    """
+    cursor = self.query.clone()
+    cursor._Cursor__fields = { "_id" : 1, "_version" : 1, "_search_version" : 1 }
+    if no_timeout:
+      cursor._Cursor__timeout = False
+    if search:
+      return ((x["_id"], x.get("_search_version", x.get("_version"))) for x in cursor)
+    return ((x["_id"], x.get("_version")) for x in cursor)
+
+  def exists(self):
+    """
+    Returns true if this result set contains at least one document. Only a
+    single identifier is fetched from the database.
+    """
+    for x in self._id_cursor().limit(1):
+      return True
+
+    return False
+
+  def _chunked_ids(self):
+    """
+    Evaluates this result set (honoring limit, skip and sort order) and
+    returns a list of chunks of database identifiers.
+    """
+    # Documents to be modified must be resolved on the primary
+    chunks = [[]]
+    for doc_id in (x["_id"] for x in set_read_preference(self._id_cursor(), "PRIMARY")):
+      if len(chunks[-1]) >= BULK_CHUNK_SIZE:
+        chunks.append([])
+      chunks[-1].append(doc_id)
+
+    return [chunk for chunk in chunks if chunk]
+
+  def update(self, **changes):
+    """
+    Performs a server-side update of all documents in this result set. Values
+    are converted using field converters and the document version is
+    incremented. Editorial mutexes are acquired for every chunk of documents,
+    so concurrent saves cannot overwrite the changes; documents that remain
+    locked by others after BULK_LOCK_RETRIES attempts are skipped and
+    MutexNotAcquired is raised with their identifiers once all other
+    documents have been updated. Document revisions are not created.
+
+    Documents are not loaded, so values are validated without a document
+    context and fields are not prepared for saving. Fields that are validated
+    against other fields may not be updated, and neither may fields from which
+    the values of other fields are derived when saving (for example dynamic
+    fields and slugs). Automatically updated date/time fields are set to the
+    current time.
+
+    @return: Number of updated documents
+    """
+    meta = self.document._meta
+    d_set, d_unset = {}, {}
+    for key, value in changes.iteritems():
+      field = meta.get_field_by_name(key)
+      if field is meta.get_primary_key_field():
+        raise ValueError("Primary key of document '{0}' cannot be updated!".format(self.document.__name__))
+      elif field.virtual:
+        raise ValueError("Virtual field '{0}' cannot be updated!".format(key))
+      elif field.get_validation_dependencies():
+        raise ValueError("Field '{0}' is validated against other fields and cannot be updated in bulk!".format(key))
+
+      field._validate(value, None)
+      if value is None:
+        d_unset[field.db_name] = 1
+      else:
+        d_set[field.db_name] = field.to_store(value, None)
+
+    if not d_set and not d_unset:
+      return 0
+
+    # Values of derived fields would become stale, as they are not recomputed
+    for field in meta.db_fields.values():
+      dependencies = field.get_save_dependencies()
+      if field.name in changes:
+        continue
+      elif dependencies is None or dependencies.intersection(changes):
+        raise ValueError("Field '{0}' is derived from updated fields and cannot be recomputed in bulk!".format(field.name))
+      elif getattr(field, 'auto_update', False):
+        d_set[field.db_name] = field.to_store(datetime.datetime.utcnow(), None)
+
+    if meta.revisable:
+      d_set['_last_update'] = datetime.datetime.utcnow()
+      d_set['_last_author'] = None
+
+    # Commit the changes, incrementing version and releasing the update mutex
+    d_set['_mutex'] = datetime.datetime.utcnow() - datetime.timedelta(hours = 1)
+    d_unset['_mutex_owner'] = 1
+    document = { '$set' : d_set, '$unset' : d_unset, '$inc' : { '_version' : 1 } }
+
+    # Determine whether any cached references depend on the modified fields
+    modified_fields = set(changes.keys())
+    sync_references = any(
+      set(field.dependencies).intersection(modified_fields)
+      for doc_class, field_path, field in meta.reverse_references
+    )
+
+    # Tasks recorded in the outbox are written together with the documents
+    pending = []
+    if meta.searchable:
+      pending.append(outbox.SEARCH_UPDATE)
+    if sync_references:
+      pending.append(outbox.CACHE_SYNC)
+    recorded = outbox.recorded_tasks(pending)
+    if recorded:
+      document['$pushAll'] = { outbox.OUTBOX_FIELD : outbox.make_entries(recorded, modified_fields) }
+
+    # Identifiers must be resolved before updating, as the changes may alter
+    # which documents match the specification
+    count = 0
+    skipped = []
+    for chunk in self._chunked_ids():
+      for attempt in xrange(BULK_LOCK_RETRIES + 1):
+        if attempt:
+          time.sleep(1.0)
+
+        owner, locked, chunk = self._lock_chunk(chunk)
+        if locked:
+          meta.collection.update(
+            { "_id" : { "$in" : locked }, "_mutex_owner" : owner },
+            document,
+            multi = True,
+            safe = True
+          )
+          count += len(locked)
+
+          if outbox.SEARCH_UPDATE in pending and outbox.SEARCH_UPDATE not in recorded:
+            indexer.dispatch_update(self.document, locked)
+
+          if outbox.CACHE_SYNC in pending and outbox.CACHE_SYNC not in recorded:
+            outbox.dispatch_cache_sync(self.document, locked, modified_fields)
+
+        if not chunk:
+          break
+
+      skipped.extend(chunk)
+
+    if skipped:
+      raise exceptions.MutexNotAcquired(skipped)
+
+    return count
+
+  def _lock_chunk(self, chunk):
+    """
+    Acquires editorial mutexes of documents with the given identifiers that
+    are not locked by others. Locked documents are marked with a unique
+    owner, so that only their mutexes are released when committing.
+
+    @param chunk: A list of database identifiers
+    @return: A tuple (owner, locked, busy) where locked and busy are lists of
+      identifiers of locked documents and of existing documents locked by others
+    """
+    collection = self.document._meta.collection
+    now = datetime.datetime.utcnow()
+    owner = uuid.uuid4().hex
+    collection.update(
+      { "_id" : { "$in" : chunk }, "_mutex" : { "$lt" : now } },
+      { "$set" : { "_mutex" : now + datetime.timedelta(seconds = 30), "_mutex_owner" : owner } },
+      multi = True,
+      safe = True
+    )
+
+    locked, busy = [], []
+    for document in collection.find({ "_id" : { "$in" : chunk } }, fields = ["_mutex_owner"]):
+      if document.get("_mutex_owner") == owner:
+        locked.append(document["_id"])
+      else:
+        busy.append(document["_id"])
+
+    return owner, locked, busy
+
+  def _check_delete_restrict(self, chunk):
+    """
+    Check if there are any reverse references that prevent deletion of
+    documents with the given identifiers. Documents that should be deleted in
+    cascade are checked recursively.
+
+    @param chunk: A list of database identifiers
+    @return: A list of (result set, chunks, cascades) tuples describing documents
+      that should be deleted in cascade, where cascades are results of checking
+      the individual chunks
+    """
+    from .document import RESTRICT, CASCADE
+
+    cascades = []
+    for doc_class, field_path, field in self.document._meta.reverse_references:
+      db_path = ".".join(doc_class._meta.resolve_subfield_hierarchy(field_path.split(".")))
+      spec = { db_path : { "$in" : chunk } }
+      documents = DbResultSet(doc_class, spec, doc_class._meta.collection.find(spec))
+      if field.on_delete == RESTRICT:
+        if documents.exists():
+          raise exceptions.DeleteRestrictedByReference
+      elif field.on_delete == CASCADE:
+        cascade_chunks = documents._chunked_ids()
+        cascades.append((
+          documents,
+          cascade_chunks,
+          [documents._check_delete_restrict(cascade_chunk) for cascade_chunk in cascade_chunks]
+        ))
+
+    return cascades
+
+  def _delete_chunks(self, chunks, cascades):
+    """
+    Deletes documents with the given identifiers together with documents
+    that should be deleted in cascade.
+
+    @param chunks: A list of chunks of database identifiers
+    @param cascades: Results of checking the individual chunks
+    @return: Number of deleted documents
+    """
+    meta = self.document._meta
+    count = 0
+    for chunk in chunks:
+      if meta.searchable:
+        # Removals from the search index are versioned by the last versions
+        versions = dict(
+          (document["_id"], document.get("_version"))
+          for document in meta.collection.find({ "_id" : { "$in" : chunk } }, fields = ["_version"])
+        )
+        chunk = [doc_id for doc_id in chunk if doc_id in versions]
+        indexer.prepare_remove(self.document, chunk, [versions[doc_id] for doc_id in chunk])
+      meta.collection.remove({ "_id" : { "$in" : chunk } }, safe = True)
+      if meta.revisable:
+        meta.revisions.remove({ "doc" : { "$in" : chunk } }, safe = True)
+      if meta.searchable:
+        indexer.dispatch_remove(self.document, chunk, [versions[doc_id] for doc_id in chunk])
+      count += len(chunk)
+
+    # Delete all referenced documents
+    for chunk_cascades in cascades:
+      for documents, cascade_chunks, cascade_cascades in chunk_cascades:
+        documents._delete_chunks(cascade_chunks, cascade_cascades)
+
+    return count
+
+  def delete(self):
+    """
+    Performs a server-side delete of all documents in this result set. Reverse
+    references are checked and cascaded the same way as when deleting single
+    documents, but the editorial mutex is bypassed.
+
+    @return: Number of deleted documents
+    """
+    chunks = self._chunked_ids()
+
+    # Check all restrictions before deleting anything
+    cascades = [self._check_delete_restrict(chunk) for chunk in chunks]
+    return self._delete_chunks(chunks, cascades)
   
+  def _resolve_db_path(self, field):
+    """
+    Resolves a dot-separated Itsy field name into a database field path.
+
+    @param field: Itsy field name
+    """
+    return ".".join(self.document._meta.resolve_subfield_hierarchy(field.split(".")))
+
+  def aggregate(self, *group_by, **aggregates):
+    """
+    Performs a server-side aggregation over this result set and returns a
+    list of plain dictionaries, one per group. Each row contains grouped
+    fields and aggregates under the names they were specified with.
+
+      >>> Book.find(year__gte = 2000).aggregate("author.name", n = Count(), pages = Sum("pages"))
+
+    @param group_by: Itsy field names to group by (subfields are separated by dots)
+    @param aggregates: Aggregate instances keyed by their result names
+    @return: A list of rows
+    """
+    pipeline = [{ "$match" : self.spec }]
+
+    # Limit and skip are applied before grouping (same as for count)
+    if self._has_skip or self._has_limit:
+      if self.query._Cursor__ordering:
+        pipeline.append({ "$sort" : self.query._Cursor__ordering })
+      if self.query._Cursor__skip:
+        pipeline.append({ "$skip" : self.query._Cursor__skip })
+      if self.query._Cursor__limit:
+        pipeline.append({ "$limit" : self.query._Cursor__limit })
+
+    # Group keys may not contain dots, so positional aliases are used
+    group = { "_id" : dict(
+      ("k{0}".format(i), "${0}".format(self._resolve_db_path(field)))
+      for i, field in enumerate(group_by)
+    ) or None }
+    for name, aggregate in aggregates.iteritems():
+      group[name] = aggregate.serialize(self.document)
+    pipeline.append({ "$group" : group })
+
+    collection = self.document._meta.collection
+    result = collection.database.command("aggregate", collection.name, pipeline = pipeline)
+
+    rows = []
+    for entry in result["result"]:
+      key = entry.pop("_id") or {}
+      for i, field in enumerate(group_by):
+        entry[field] = key.get("k{0}".format(i))
+      rows.append(entry)
+
+    return rows
+
+  def distinct(self, field):
+    """
+    Returns a list of distinct values of a field in this result set.
+
+    @param field: Itsy field name (subfields are separated by dots)
+    """
+    return self.query.distinct(self._resolve_db_path(field))
+
   def _to_document(self, document):
     """
     Converts a pymongo document dictionary into a valid document object
@@ -160,6 +594,11 @@ class DbResultSet(object):
     """
     obj = self.document()
     obj._set_from_db(document)
+    if self._only_fields or self._defer_fields:
+      if self._unloaded is None:
+        self._unloaded = self._unloaded_fields()
+      obj._deferred_fields = set(self._unloaded[0])
+      obj._partial_fields = set(self._unloaded[1])
     return obj
   
   def __len__(self):
@@ -186,6 +625,54 @@ class DbResultSet(object):
     for document in self.query:
       yield self._to_document(document)
 
+  def afetch(self):
+    """
+    Evaluates this result set asynchronously.
+
+    @return: A Future resolving to a list of documents
+    """
+    # A list comprehension avoids a separate count request made by list()
+    return concurrency.submit(lambda rs: [document for document in rs], self.all())
+
+  def iterator(self, chunk_size = 1000, no_timeout = False, max_time_ms = None, on_chunk = None):
+    """
+    Evaluates this result set in chunks, fetching at most `chunk_size`
+    documents per round-trip. The underlying cursor is closed as soon as
+    iteration finishes or the generator is closed.
+
+    @param chunk_size: Number of documents fetched per chunk
+    @param no_timeout: Should the server-side cursor timeout be disabled
+    @param max_time_ms: Optional server-side time limit for the query
+    @param on_chunk: Optional callable invoked with a list of documents before they are yielded
+    """
+    cursor = self.query.clone()
+    cursor.batch_size(chunk_size)
+    if no_timeout:
+      cursor._Cursor__timeout = False
+    if max_time_ms is not None:
+      cursor.max_time_ms(max_time_ms)
+
+    try:
+      chunk = []
+      for document in cursor:
+        chunk.append(self._to_document(document))
+        if len(chunk) < chunk_size:
+          continue
+
+        if on_chunk is not None:
+          on_chunk(chunk)
+        for document in chunk:
+          yield document
+        chunk = []
+
+      if chunk:
+        if on_chunk is not None:
+          on_chunk(chunk)
+        for document in chunk:
+          yield document
+    finally:
+      cursor.close()
+
 class SearchResultSet(object):
   """
   Wrapper for Elastic Search result sets.
@@ -207,6 +694,17 @@ class SearchResultSet(object):
     self._evaluated = False
     self._results = None
     self._only_fields = set()
+    self._page_size = 50
+    self._prefetch = False
+    self._pages = collections.OrderedDict()
+    self._prefetching = {}
+    self._page_lock = threading.Lock()
+    self._total = None
+    self._facets = None
+    self._facet_results = None
+    self._count_only = False
+    self._use_cache = True
+    self._error = None
 
   def all(self):
     """
@@ -221,44 +719,406 @@ class SearchResultSet(object):
     rs._evaluated = self._evaluated
     rs._results = self._results
     rs._only_fields = self._only_fields
+    rs._page_size = self._page_size
+    rs._prefetch = self._prefetch
+    rs._total = self._total
+    rs._facets = dict(self._facets) if self._facets else None
+    rs._count_only = self._count_only
+    rs._use_cache = self._use_cache
     return rs
 
+  def _invalidate(self):
+    """
+    Invalidates evaluated results and cached pages.
+    """
+    self._evaluated = False
+    self._error = None
+    self._total = None
+    self._facet_results = None
+    with self._page_lock:
+      self._pages.clear()
+      self._prefetching.clear()
+
+  def paged(self, page_size = 50, prefetch = False):
+    """
+    Configures how indexing and slicing fetch results. Only pages covering
+    the requested items are fetched and a few recently used pages are cached.
+
+    @param page_size: Number of hits fetched per request
+    @param prefetch: Should the next page be fetched in the background
+    """
+    self._invalidate()
+    self._page_size = int(page_size)
+    self._prefetch = prefetch
+    return self
+
+  def _request_page(self, page):
+    """
+    Fetches hits of the given page from the search engine.
+
+    @param page: Page number
+    @return: A list of hits
+    """
+    if self._error is not None:
+      raise self._error
+
+    query, params = self._build_request()
+    start = page * self._page_size
+    size = self._page_size
+    if self._limit is not None:
+      size = min(size, int(self._limit) - start)
+      if size <= 0:
+        return []
+
+    params['from'] = int(self._offset or 0) + start
+    params['size'] = 0 if self._count_only else size
+    results = self._search(query, params)
+    self._total = results['hits']['total']
+    self._facet_results = results.get('facets')
+    return results['hits']['hits']
+
+  def _store_page(self, page, hits):
+    """
+    Stores a page in the page cache, evicting least recently used pages.
+    Must be called while holding the page lock.
+    """
+    self._pages[page] = hits
+    while len(self._pages) > SEARCH_PAGE_CACHE_SIZE:
+      self._pages.popitem(last = False)
+
+  def _prefetch_page(self, page):
+    """
+    Starts fetching the given page in the background.
+    """
+    def fetch():
+      try:
+        hits = self._request_page(page)
+      except Exception:
+        # The page will be fetched again when it is needed
+        return
+
+      with self._page_lock:
+        if self._prefetching.get(page) is thread:
+          self._store_page(page, hits)
+
+    with self._page_lock:
+      if page in self._pages or page in self._prefetching:
+        return
+
+      thread = threading.Thread(target = fetch)
+      thread.daemon = True
+      self._prefetching[page] = thread
+
+    thread.start()
+
+  def _get_page(self, page):
+    """
+    Returns hits of the given page, fetching it when it is not cached.
+
+    @param page: Page number
+    @return: A list of hits
+    """
+    with self._page_lock:
+      hits = self._pages.pop(page, None)
+      if hits is not None:
+        self._pages[page] = hits
+      thread = self._prefetching.get(page)
+
+    if hits is None and thread is not None:
+      thread.join()
+      with self._page_lock:
+        hits = self._pages.get(page)
+
+    if hits is None:
+      hits = self._request_page(page)
+      with self._page_lock:
+        self._store_page(page, hits)
+
+    with self._page_lock:
+      self._prefetching.pop(page, None)
+
+    if self._prefetch and len(hits) == self._page_size:
+      self._prefetch_page(page + 1)
+
+    return hits
+
+  def count(self):
+    """
+    Returns the number of documents in this result set, taking offset and
+    limit into account.
+    """
+    return len(self)
+
+  def __len__(self):
+    """
+    Returns the number of documents in this result set, taking offset and
+    limit into account.
+    """
+    if self._total is None and not self._evaluated:
+      # Fetching the first page also obtains the total number of hits
+      self._get_page(0)
+
+    count = max(0, self.total - int(self._offset or 0))
+    if self._limit is not None:
+      count = min(count, int(self._limit))
+    return count
+
+  def __getitem__(self, key):
+    """
+    Returns the specified document or a list of documents, only fetching
+    pages that contain them.
+    """
+    if isinstance(key, slice):
+      if key.step not in (None, 1):
+        raise ValueError("Slice steps are not supported!")
+
+      # The number of documents is only needed to resolve negative bounds;
+      # open slices are read until a page comes back short
+      start, stop = key.start, key.stop
+      if (start is not None and start < 0) or (stop is not None and stop < 0):
+        start, stop, step = key.indices(len(self))
+      else:
+        start = start or 0
+        if self._limit is not None:
+          stop = int(self._limit) if stop is None else min(stop, int(self._limit))
+
+      hits = []
+      page = start // self._page_size
+      while stop is None or (start < stop and page * self._page_size < stop):
+        page_hits = self._get_page(page)
+        base = page * self._page_size
+        hits.extend(page_hits[max(0, start - base):None if stop is None else stop - base])
+        if len(page_hits) < self._page_size:
+          break
+        page += 1
+
+      return [self._to_document(hit) for hit in hits]
+    elif isinstance(key, (int, long)):
+      if key < 0:
+        key += len(self)
+      if key < 0 or (self._limit is not None and key >= self._limit):
+        raise IndexError("Result set index out of range!")
+
+      page_hits = self._get_page(key // self._page_size)
+      try:
+        return self._to_document(page_hits[key % self._page_size])
+      except IndexError:
+        raise IndexError("Result set index out of range!")
+    else:
+      raise TypeError("Indices must be integers or slices!")
+
+  def _build_request(self):
+    """
+    Builds the search request body and request parameters.
+
+    @return: A tuple (query, params)
+    """
+    query = { 'query' : self._query.serialize() }
+    if self._min_score is not None:
+      query['min_score'] = self._min_score
+    if self._highlight is not None:
+      query['highlight'] = self._highlight
+    if self._order is not None:
+      query['sort'] = self._order
+    if self._facets:
+      query['facets'] = self._facets
+
+    params = {}
+    if self._offset is not None:
+      params['from'] = int(self._offset)
+    if self._limit is not None:
+      params['size'] = int(self._limit)
+    if self._count_only:
+      params['size'] = 0
+    if self._only_fields:
+      params['fields'] = ",".join(self._only_fields)
+
+    return query, params
+
+  def _set_results(self, results):
+    """
+    Populates this result set from a search response.
+
+    @param results: Search response
+    """
+    self._results = results
+    self._total = results['hits']['total']
+    self._facet_results = results.get('facets')
+    self._evaluated = True
+    self._error = None
+
+  def _cache_key(self, query, params):
+    """
+    Returns the search result cache key for the given request or None when
+    the cache should not be used.
+    """
+    if self._use_cache and search_cache.enabled:
+      return search_cache.make_key(self._document, query, params)
+
+  def _search(self, query, params):
+    """
+    Performs a search request, using the search result cache when enabled.
+
+    @param query: Search request body
+    @param params: Search request parameters
+    @return: Search response
+    """
+    key = self._cache_key(query, params)
+    if key is None:
+      return self._document._meta.search_engine.search(query, **params)
+
+    results = search_cache.get(key)
+    if results is None:
+      started = time.time()
+      results = self._document._meta.search_engine.search(query, **params)
+      search_cache.set(key, results, started)
+
+    return results
+
   def _evaluate(self):
     """
     Evaluates this result set if it hasn't yet been evaluated.
     """
-    if not self._evaluated:
-      query = { 'query' : self._query.serialize() }
-      if self._min_score is not None:
-        query['min_score'] = self._min_score
-      if self._highlight is not None:
-        query['highlight'] = self._highlight
-      if self._order is not None:
-        query['sort'] = self._order
-
-      params = {}
-      if self._offset is not None:
-        params['from'] = int(self._offset)
-      if self._limit is not None:
-        params['size'] = int(self._limit)
-      if self._only_fields:
-        params['fields'] = ",".join(self._only_fields)
+    if self._error is not None:
+      raise self._error
 
-      self._results = self._document._meta.search_engine.search(
-        query,
-        **params
-      )
-      self._evaluated = True
+    if not self._evaluated:
+      query, params = self._build_request()
+      self._set_results(self._search(query, params))
 
     return self._results
 
+  def aevaluate(self):
+    """
+    Evaluates this result set asynchronously.
+
+    @return: A Future resolving to a list of documents
+    """
+    # A list comprehension avoids a separate count request made by list()
+    return concurrency.submit(lambda: [document for document in self])
+
+  def cache(self, enabled = True):
+    """
+    Enables or disables use of the search result cache for this result set.
+    The cache must also be enabled via ITSY_SEARCH_CACHE settings.
+
+    @param enabled: Should the cache be used
+    """
+    self._invalidate()
+    self._use_cache = enabled
+    return self
+
+  @staticmethod
+  def evaluate_many(*result_sets):
+    """
+    Evaluates multiple result sets (possibly for different document classes)
+    using a single multi-search round-trip. Result sets with cached responses
+    are not searched again. Errors of result sets that fail to evaluate are
+    stored and raised when they are used.
+
+    @param result_sets: SearchResultSet instances
+    """
+    pending = []
+    requests = []
+    for rs in result_sets:
+      if rs._evaluated:
+        continue
+
+      query, params = rs._build_request()
+      key = rs._cache_key(query, params)
+      if key is not None:
+        results = search_cache.get(key)
+        if results is not None:
+          rs._set_results(results)
+          continue
+
+      pending.append((rs, key))
+      requests.append(rs._document._meta.search_engine.msearch_request(query, **params))
+
+    if not pending:
+      return
+
+    started = time.time()
+    responses = pending[0][0]._document._meta.search_engine.msearch(requests)
+    for (rs, key), response in zip(pending, responses):
+      if 'error' in response:
+        rs._error = pyes.exceptions.ElasticSearchException(response['error'], response.get('status'), response)
+      else:
+        rs._set_results(response)
+        if key is not None:
+          search_cache.set(key, response, started)
+
+  @staticmethod
+  def hydrate_many(*result_sets):
+    """
+    Evaluates multiple result sets using a single multi-search round-trip
+    and then loads their documents from the database concurrently.
+
+    @param result_sets: SearchResultSet instances
+    @return: A list of document lists, one for each result set
+    """
+    SearchResultSet.evaluate_many(*result_sets)
+    return concurrency.fan_out(*[rs.hydrate for rs in result_sets])
+
+  def scan(self, batch_size = 500, keep_alive = "5m"):
+    """
+    Streams all matching documents using the scroll API, so that memory
+    usage is constant regardless of the number of results. When no sort
+    order has been specified, the more efficient scan search type is used.
+    The scroll context is cleared when the generator is exhausted or closed.
+
+    @param batch_size: Number of hits fetched per request (per shard when scanning)
+    @param keep_alive: How long should the scroll context be kept alive between requests
+    """
+    if self._limit is not None and self._limit <= 0:
+      return
+
+    engine = self._document._meta.search_engine
+    query, params = self._build_request()
+    params.pop('from', None)
+    params['size'] = int(batch_size)
+    params['scroll'] = keep_alive
+
+    # The scan search type returns no hits in the first response
+    scanning = self._order is None
+    if scanning:
+      params['search_type'] = 'scan'
+
+    results = engine.search(query, **params)
+    scroll_id = results.get('_scroll_id')
+    skip = self._offset or 0
+    remaining = self._limit
+    try:
+      while True:
+        hits = results['hits']['hits']
+        if hits:
+          for hit in hits:
+            if skip > 0:
+              skip -= 1
+              continue
+
+            yield self._to_document(hit)
+            if remaining is not None:
+              remaining -= 1
+              if remaining <= 0:
+                return
+        elif not scanning:
+          break
+
+        scanning = False
+        results = engine.scroll(scroll_id, keep_alive)
+        scroll_id = results.get('_scroll_id', scroll_id)
+    finally:
+      if scroll_id is not None:
+        engine.clear_scroll(scroll_id)
+
   def limit(self, limit):
     """
     Limits this result set to some amount of entries.
 
     @param limit: Number of entries to limit to
     """
-    self._evaluated = False
+    self._invalidate()
     self._limit = limit
     return self
 
@@ -268,7 +1128,7 @@ class SearchResultSet(object):
 
     @param skip: Number of entries to skip
     """
-    self._evaluated = False
+    self._invalidate()
     self._offset = skip
     return self
 
@@ -288,7 +1148,7 @@ class SearchResultSet(object):
 
     @param score: Minimum score
     """
-    self._evaluated = False
+    self._invalidate()
     self._min_score = score
     return self
 
@@ -296,7 +1156,7 @@ class SearchResultSet(object):
     """
     Sets up the highlight descriptor.
     """
-    self._evaluated = False
+    self._invalidate()
     self._highlight = highlight
     return self
 
@@ -304,7 +1164,7 @@ class SearchResultSet(object):
     """
     Orders the result set by a specific field or fields.
     """
-    self._evaluated = False
+    self._invalidate()
     if self._order is None:
       self._order = []
 
@@ -318,11 +1178,85 @@ class SearchResultSet(object):
 
     return self
 
+  def _check_search_field(self, field):
+    """
+    Checks that a field with the given name exists in the search mapping.
+
+    @param field: Itsy field name (subfields are separated by dots)
+    """
+    properties = self._document._meta.search_mapping_prepare()
+    mapping = None
+    for element in field.split("."):
+      if properties is None or element not in properties:
+        raise KeyError("Field '{0}' is not searchable in document '{1}'!".format(field, self._document.__name__))
+
+      mapping = properties[element]
+      properties = mapping.get("properties")
+
+    if mapping.get("type") == "object":
+      raise ValueError("Cannot compute facets on object field '{0}'!".format(field))
+
+  def facet(self, field, name = None, size = 10, statistical = False):
+    """
+    Requests a facet to be computed together with the hits. Facet results
+    are available via `get_facets`.
+
+    @param field: Itsy field name (subfields are separated by dots)
+    @param name: Optional facet name (defaults to the field name)
+    @param size: Maximum number of terms to return
+    @param statistical: Compute statistics over a numeric field instead of term counts
+    """
+    self._check_search_field(field)
+    self._invalidate()
+    if self._facets is None:
+      self._facets = {}
+
+    if statistical:
+      self._facets[name or field] = { "statistical" : { "field" : field } }
+    else:
+      self._facets[name or field] = { "terms" : { "field" : field, "size" : int(size) } }
+
+    return self
+
+  def count_only(self):
+    """
+    Configures this result set to only compute the total number of hits and
+    facets without fetching any hits.
+    """
+    self._invalidate()
+    self._count_only = True
+    return self
+
+  def get_facets(self):
+    """
+    Returns parsed facet results. Term facets are returned as lists of
+    buckets (dictionaries with `value` and `count` keys), statistical
+    facets as dictionaries of statistics.
+    """
+    if self._facet_results is None:
+      self._evaluate()
+
+    facets = {}
+    for name, result in (self._facet_results or {}).iteritems():
+      if result.get("_type") == "terms":
+        facets[name] = [
+          { "value" : term["term"], "count" : term["count"] }
+          for term in result["terms"]
+        ]
+      else:
+        facets[name] = dict((k, v) for k, v in result.iteritems() if k != "_type")
+
+    return facets
+
   @property
   def total(self):
     """
-    Returns the total number of hits.
+    Returns the total number of hits. The total is reused from any previously
+    fetched page.
     """
+    if self._total is not None:
+      return self._total
+
     return self._evaluate()['hits']['total']
 
   def _to_document(self, hit):
@@ -336,6 +1270,41 @@ class SearchResultSet(object):
       hit['fields'][self._document._meta.get_primary_key_field().name] = hit['_id']
       obj._set_from_search(hit['fields'], hit.get('highlight'))
     return obj
+
+  def hydrate(self, remove_missing = True):
+    """
+    Loads the documents of the current page from the database using a single
+    query and returns them in the order of search hits. Highlight metadata is
+    attached to the loaded documents.
+
+    @param remove_missing: Should hits that no longer exist in the database be removed from the index
+    @return: A list of documents
+    """
+    pk_field = self._document._meta.get_primary_key_field()
+    hits = self._evaluate()['hits']['hits']
+    pks = [pk_field.from_search(hit['_id'], None) for hit in hits]
+
+    documents = {}
+    if pks:
+      for document in self._document.find(pk__in = pks).read_preference("PRIMARY"):
+        documents[document.pk] = document
+
+    result = []
+    missing = []
+    for pk, hit in zip(pks, hits):
+      document = documents.get(pk)
+      if document is None:
+        missing.append(hit['_id'])
+        continue
+
+      document._highlight = hit.get('highlight')
+      result.append(document)
+
+    if missing and remove_missing:
+      # Documents have been deleted from the database but are still in the index
+      common_tasks.search_index_remove_batch.delay(self._document, missing)
+
+    return result
   
   def __iter__(self):
     """
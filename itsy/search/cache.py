@@ -0,0 +1,169 @@
+import collections
+import copy
+import hashlib
+import json
+import threading
+import time
+
+from django.core.cache import cache as shared_cache
+
+class SearchResultCache(object):
+  """
+  A bounded in-process cache of search responses keyed by a normalized hash
+  of the search request. Entries expire after a timeout and are invalidated
+  per document class; invalidation generations are kept in the shared Django
+  cache, so invalidations performed by background workers are visible to
+  all processes after at most `sync_interval` seconds.
+
+  Updates only become visible to searches after the index is refreshed, so
+  responses to searches started less than `refresh_interval` seconds after
+  an invalidation are not cached.
+  """
+  def __init__(self, config = None):
+    """
+    Class constructor.
+
+    @param config: Cache configuration (None disables the cache)
+    """
+    config = config or {}
+    self.enabled = bool(config.get("enabled", bool(config)))
+    self.timeout = config.get("timeout", 60)
+    self.max_entries = config.get("max_entries", 1000)
+    self.refresh_interval = float(config.get("refresh_interval", 1.0))
+    self.sync_interval = float(config.get("sync_interval", 1.0))
+    self._entries = collections.OrderedDict()
+    self._states = {}
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+
+  def _class_key(self, doc_class):
+    """
+    Returns a key that identifies the given document class.
+    """
+    return "{0}.{1}".format(doc_class._meta.collection_base, doc_class._meta.classname)
+
+  def _state_keys(self, class_key):
+    """
+    Returns shared cache keys holding the invalidation generation and the
+    end of the refresh window of a document class.
+    """
+    generation_key = "itsy.search_cache.{0}".format(class_key)
+    return generation_key, "{0}.dirty".format(generation_key)
+
+  def _state(self, class_key):
+    """
+    Returns a (generation, dirty until) tuple for a document class. The state
+    is only synchronized with the shared cache every `sync_interval` seconds,
+    so lookups don't require a shared cache round-trip.
+
+    @param class_key: Key as returned by `_class_key`
+    """
+    now = time.time()
+    with self._lock:
+      state = self._states.get(class_key)
+      if state is not None and state[2] > now:
+        return state[:2]
+
+    generation_key, dirty_key = self._state_keys(class_key)
+    values = shared_cache.get_many([generation_key, dirty_key])
+    state = (values.get(generation_key) or 0, values.get(dirty_key) or 0.0, now + self.sync_interval)
+    with self._lock:
+      self._states[class_key] = state
+
+    return state[:2]
+
+  def make_key(self, doc_class, query, params):
+    """
+    Computes a cache key for the given search request.
+
+    @param doc_class: Document class
+    @param query: Search request body
+    @param params: Search request parameters
+    """
+    class_key = self._class_key(doc_class)
+    request = json.dumps(
+      [class_key, query, params],
+      sort_keys = True,
+      separators = (",", ":"),
+      default = str
+    )
+    return class_key, hashlib.sha1(request).hexdigest(), self._state(class_key)[0]
+
+  def get(self, key):
+    """
+    Returns a cached response or None when there is no valid entry.
+
+    @param key: Key as returned by `make_key`
+    """
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None or entry[0] < time.time():
+        self.misses += 1
+        return None
+
+      self._entries[key] = entry
+      self.hits += 1
+
+    return copy.deepcopy(entry[1])
+
+  def set(self, key, results, started):
+    """
+    Stores a response into the cache, evicting least recently used entries.
+    Responses to searches that were started before the index has been
+    refreshed after the last invalidation are not stored.
+
+    @param key: Key as returned by `make_key`
+    @param results: Search response
+    @param started: Time when the search request was started
+    """
+    generation, dirty_until = self._state(key[0])
+    if generation != key[2] or started < dirty_until:
+      return
+
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (time.time() + self.timeout, copy.deepcopy(results))
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last = False)
+
+  def invalidate(self, doc_class):
+    """
+    Invalidates all cached responses for the given document class.
+
+    @param doc_class: Document class
+    """
+    if not self.enabled:
+      return
+
+    class_key = self._class_key(doc_class)
+    generation_key, dirty_key = self._state_keys(class_key)
+    now = time.time()
+    dirty_until = now + self.refresh_interval
+    shared_cache.set(dirty_key, dirty_until, None)
+    try:
+      generation = shared_cache.incr(generation_key)
+    except ValueError:
+      generation = 1
+      shared_cache.set(generation_key, generation, None)
+
+    with self._lock:
+      for key in [key for key in self._entries if key[0] == class_key]:
+        del self._entries[key]
+      self._states[class_key] = (generation, dirty_until, now + self.sync_interval)
+      self.invalidations += 1
+
+  def stats(self):
+    """
+    Returns cache metrics.
+    """
+    with self._lock:
+      lookups = self.hits + self.misses
+      return dict(
+        entries = len(self._entries),
+        hits = self.hits,
+        misses = self.misses,
+        invalidations = self.invalidations,
+        hit_rate = float(self.hits) / lookups if lookups else 0.0,
+      )
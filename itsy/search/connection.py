@@ -1,40 +1,324 @@
 from __future__ import absolute_import
 
+import json
+import re
+import threading
+
 import pyes
+import pyes.exceptions
+from pyes.es import ESJsonEncoder
+
+from .. import concurrency, exceptions
+from ..metrics import metrics
+from .pool import SearchNodePool
+
+# Index settings that can only be configured on index creation
+STATIC_SETTINGS = ("index.number_of_shards",)
+
+# Values that Elastic Search omits when returning mappings
+DEFAULT_MAPPING_VALUES = {
+  "boost" : "1.0",
+  "store" : "false",
+  "index" : "analyzed",
+  "enabled" : "true",
+}
+
+# Pattern of numeric setting or mapping values
+NUMBER_PATTERN = re.compile(r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$")
+
+def _normalize_value(value):
+  """
+  Normalizes a setting or mapping value for comparison. Numbers are
+  normalized so that integral values compare equal regardless of whether
+  they are given as integers or floats.
+  """
+  if isinstance(value, bool) or value in ("yes", "no"):
+    return "true" if value in (True, "yes") else "false"
+  elif isinstance(value, (list, tuple)):
+    return ",".join([_normalize_value(x) for x in value])
+  elif isinstance(value, (int, long, float)) or (isinstance(value, basestring) and NUMBER_PATTERN.match(value)):
+    value = float(value)
+    return unicode(int(value)) if value.is_integer() else unicode(value)
+
+  return unicode(value)
+
+def _flatten_settings(settings, prefix = ""):
+  """
+  Flattens nested index settings into dotted keys.
+  """
+  flat = {}
+  for key, value in settings.iteritems():
+    key = prefix + key
+    if isinstance(value, dict):
+      flat.update(_flatten_settings(value, key + "."))
+    elif isinstance(value, (list, tuple)):
+      for i, element in enumerate(value):
+        flat["{0}.{1}".format(key, i)] = _normalize_value(element)
+    else:
+      flat[key] = _normalize_value(value)
+
+  return flat
+
+def _settings_component(config, path):
+  """
+  Returns the nested value of an index setting given by a dotted path.
+
+  @param config: Index configuration
+  @param path: Dotted path without the "index." prefix
+  """
+  for value in (config.get("index"), config):
+    for key in path.split("."):
+      value = value.get(key) if isinstance(value, dict) else None
+
+    if value is not None:
+      return value
+
+def _analysis_component(key):
+  """
+  Returns the flattened key of the analysis component (e.g. an analyzer or a
+  filter) that a flattened analysis setting belongs to.
+  """
+  return ".".join(key.split(".")[:4])
+
+def _mapping_diff(desired, current, path = ""):
+  """
+  Returns paths of mapping entries that differ from the current mapping.
+  Only entries present in the desired mapping are compared.
+  """
+  diffs = []
+  for key, value in desired.iteritems():
+    current_value = current.get(key)
+    if isinstance(value, dict):
+      if not isinstance(current_value, dict):
+        current_value = {}
+      diffs.extend(_mapping_diff(value, current_value, path + key + "."))
+    elif current_value is None:
+      if key not in DEFAULT_MAPPING_VALUES or _normalize_value(value) != _normalize_value(DEFAULT_MAPPING_VALUES[key]):
+        diffs.append(path + key)
+    elif _normalize_value(value) != _normalize_value(current_value):
+      diffs.append(path + key)
+
+  return diffs
 
 class DocumentSearchIndex(object):
   """
   An Elastic Search index object wrapper.
   """
-  def __init__(self, es, index, typ):
+  def __init__(self, search, index, typ):
     """
     Class constructor.
     
-    @param es: Elastic Search handle
+    @param search: Document search container holding the connection
     @param index: Index name
     @param typ: Document type
     """
-    self._es = es
+    self._search = search
     self._index = index
     self._type = typ
+    self._bulk = []
+    self._bulk_lock = threading.Lock()
+
+  @property
+  def _es(self):
+    """
+    Returns the Elastic Search handle.
+    """
+    return self._search.es
+
+  def _queue_bulk(self, *lines):
+    """
+    Queues lines of a bulk request.
+    """
+    with self._bulk_lock:
+      self._bulk.extend(lines)
   
-  def index(self, document):
+  def index(self, document, bulk = False, version = None):
     """
-    Indexes a given document.
+    Indexes a given document. When a version is given, external versioning
+    is used and writes of stale versions are rejected and counted.
+
+    @param bulk: Should the operation be queued for a bulk request
+    @param version: Optional external document version
+    @return: False when the write has been rejected as stale
     """
-    self._es.index(document, self._index, self._type, document['_id'])
+    if bulk:
+      self._queue_bulk(*self.index_action(document, version))
+      return True
+
+    kwargs = {}
+    if version is not None:
+      kwargs = dict(version = version, querystring_args = { "version_type" : "external" })
+
+    try:
+      self._es.index(document, self._index, self._type, document['_id'], **kwargs)
+    except pyes.exceptions.VersionConflictEngineException:
+      metrics.increment("search_index.stale_writes")
+      return False
+
+    return True
   
+  def index_action(self, document, version = None):
+    """
+    Returns lines of a bulk request that index a given document.
+
+    @param document: Document to index
+    @param version: Optional external document version
+    """
+    header = { "_index" : self._index, "_type" : self._type, "_id" : document['_id'] }
+    if version is not None:
+      header.update({ "_version" : version, "_version_type" : "external" })
+    return [{ "index" : header }, document]
+
+  def delete_action(self, doc_id, version = None):
+    """
+    Returns a line of a bulk request that deletes a given document.
+
+    @param doc_id: Document identifier
+    @param version: Optional last version of the deleted document
+    """
+    header = { "_index" : self._index, "_type" : self._type, "_id" : doc_id }
+    if version is not None:
+      # Deletes are versioned above the last version, so that delayed writes
+      # of any version of the deleted document are rejected as stale
+      header.update({ "_version" : version + 1, "_version_type" : "external" })
+    return { "delete" : header }
+
+  def update(self, doc_id, document, version = None):
+    """
+    Performs a partial update of an indexed document.
+
+    @param doc_id: Document identifier
+    @param document: Partial document containing the fields to update
+    @param version: Optional version the indexed document is expected to have
+    @return: False when the document does not exist in the index or has a different version
+    """
+    params = {}
+    if version is not None:
+      params['version'] = version
+
+    try:
+      self._es._send_request(
+        "POST",
+        "/{0}/{1}/{2}/_update".format(self._index, self._type, doc_id),
+        { "doc" : document },
+        params
+      )
+    except pyes.exceptions.VersionConflictEngineException:
+      return False
+    except pyes.exceptions.ElasticSearchException, e:
+      if getattr(e, 'status', None) == 404:
+        return False
+      raise
+
+    return True
+
   def refresh(self):
     """
     Refreshes the index.
     """
     self._es.refresh([self._index])
   
-  def delete(self, doc_id):
+  def delete(self, doc_id, bulk = False, version = None):
+    """
+    Deletes a document from the index. When the last version of the deleted
+    document is given, external versioning is used, so that delayed writes
+    of any of its versions are rejected.
+
+    @param bulk: Should the operation be queued for a bulk request
+    @param version: Optional last version of the deleted document
+    @return: False when the delete has been rejected as stale
+    """
+    if bulk:
+      self._queue_bulk(self.delete_action(doc_id, version))
+      return True
+
+    kwargs = {}
+    if version is not None:
+      # Deletes take query parameters directly
+      kwargs = dict(version = version + 1, version_type = "external")
+
+    try:
+      self._es.delete(self._index, self._type, doc_id, **kwargs)
+    except pyes.exceptions.VersionConflictEngineException:
+      metrics.increment("search_index.stale_writes")
+      return False
+
+    return True
+
+  def flush_bulk(self):
+    """
+    Sends all queued bulk operations. Operations rejected because of stale
+    versions are counted, other failures raise an exception.
+    """
+    with self._bulk_lock:
+      lines, self._bulk = self._bulk, []
+
+    self.send_bulk(lines)
+
+  def send_bulk(self, lines):
     """
-    Deletes a document from the index.
+    Sends a bulk request directly, bypassing the queue of bulk operations.
+    Operations rejected because of stale versions are counted. When the
+    cluster rejects operations because it is overloaded, SearchBulkRejected
+    is raised with lines of the rejected operations, so they may be retried.
+    Other failures raise SearchBulkError with all errors.
+
+    @param lines: Lines of the bulk request
     """
-    self._es.delete(self._index, self._type, doc_id)
+    if not lines:
+      return
+
+    try:
+      response = self._es._send_request(
+        "POST",
+        "/_bulk",
+        "\n".join([json.dumps(line, cls = ESJsonEncoder) for line in lines]) + "\n"
+      )
+    except pyes.exceptions.ElasticSearchException, e:
+      if getattr(e, 'status', None) in (429, 503):
+        raise exceptions.SearchBulkRejected(lines)
+      raise
+
+    # Split lines into operations, all but deletes are followed by a source line
+    operations = []
+    i = 0
+    while i < len(lines):
+      size = 1 if "delete" in lines[i] else 2
+      operations.append(lines[i:i + size])
+      i += size
+
+    errors = []
+    rejected = []
+    rejected_errors = []
+    for operation, item in zip(operations, response.get("items", [])):
+      for result in item.values():
+        error = result.get("error")
+        if not error:
+          continue
+        elif "VersionConflictEngineException" in unicode(error):
+          metrics.increment("search_index.stale_writes")
+        elif "EsRejectedExecutionException" in unicode(error):
+          rejected.extend(operation)
+          rejected_errors.append(error)
+        else:
+          errors.append(error)
+
+    if errors:
+      raise exceptions.SearchBulkError(errors + rejected_errors)
+    elif rejected:
+      raise exceptions.SearchBulkRejected(rejected)
+
+  def aflush_bulk(self):
+    """
+    Sends all queued bulk operations asynchronously. Operations queued after
+    this call are not included.
+
+    @return: A Future
+    """
+    with self._bulk_lock:
+      lines, self._bulk = self._bulk, []
+
+    return concurrency.submit(self.send_bulk, lines)
 
   def drop(self):
     """
@@ -53,6 +337,54 @@ class DocumentSearchIndex(object):
       **kwargs
     )
 
+  def scroll(self, scroll_id, keep_alive):
+    """
+    Fetches the next batch of results for a scrolled search.
+
+    @param scroll_id: Scroll identifier returned by the previous request
+    @param keep_alive: How long should the scroll context be kept alive
+    """
+    return self._es.search_scroll(scroll_id, scroll = keep_alive)
+
+  def clear_scroll(self, scroll_id):
+    """
+    Releases resources held by a scrolled search. Failures are ignored as
+    the scroll context will eventually expire on its own.
+
+    @param scroll_id: Scroll identifier
+    """
+    try:
+      self._es._send_request("DELETE", "/_search/scroll", scroll_id)
+    except Exception:
+      pass
+
+  def msearch_request(self, query, **kwargs):
+    """
+    Prepares a single request of a multi-search over this index.
+
+    @param query: Search request body
+    @return: A tuple (header, body)
+    """
+    body = dict(query)
+    for key, value in kwargs.iteritems():
+      body[key] = value.split(",") if key == "fields" else value
+
+    return { "index" : self._index, "type" : self._type }, body
+
+  def msearch(self, requests):
+    """
+    Performs multiple searches using a single round-trip.
+
+    @param requests: A list of (header, body) tuples as returned by `msearch_request`
+    @return: A list of responses, one for each request
+    """
+    lines = []
+    for header, body in requests:
+      lines.append(json.dumps(header, cls = ESJsonEncoder))
+      lines.append(json.dumps(body, cls = ESJsonEncoder))
+
+    return self._es._send_request("GET", "/_msearch", "\n".join(lines) + "\n")["responses"]
+
   def optimize(self, **kwargs):
     """
     Optimizes the search index.
@@ -71,7 +403,8 @@ class DocumentSearchIndex(object):
 
   def set_configuration(self, config, create = False):
     """
-    Sets up the index configuration.
+    Sets up the index configuration. The index is only closed when the
+    configuration contains settings that cannot be changed on an open index.
 
     :param create: Should the index be created if missing
     """
@@ -81,26 +414,161 @@ class DocumentSearchIndex(object):
     # Some items can only be configured on index creation and will cause an
     # error when attempting to dynamically "change" them
     config.get("index", {}).pop("number_of_shards", None)
+    self._update_settings(_flatten_settings(config, "index."))
+
+  def _update_settings(self, settings):
+    """
+    Updates index settings given as flattened keys, closing the index only
+    when required.
+    """
+    settings = dict(
+      (key.replace("index.index.", "index."), value) for key, value in settings.iteritems()
+    )
+    if not any(key.startswith("index.analysis.") for key in settings):
+      self._es.update_settings(self._index, settings)
+      return
 
     try:
       self._es.close_index(self._index)
-      self._es.update_settings(self._index, config)
+      self._es.update_settings(self._index, settings)
     finally:
       self._es.open_index(self._index)
 
+  def get_settings(self):
+    """
+    Returns flattened settings of this index or None when the index does
+    not exist.
+    """
+    try:
+      response = self._es._send_request("GET", "/{0}/_settings".format(self._index))
+    except pyes.exceptions.ElasticSearchException, e:
+      if getattr(e, 'status', None) == 404 or isinstance(e, pyes.exceptions.IndexMissingException):
+        return None
+      raise
+
+    settings = response.get(self._index, {}).get("settings", {})
+    return _flatten_settings(settings)
+
+  def get_mapping(self):
+    """
+    Returns the current type mapping of this index.
+    """
+    try:
+      response = self._es._send_request("GET", "/{0}/{1}/_mapping".format(self._index, self._type))
+    except pyes.exceptions.ElasticSearchException, e:
+      if getattr(e, 'status', None) == 404:
+        return {}
+      raise
+
+    if self._index in response:
+      response = response[self._index].get("mappings", response[self._index])
+
+    return response.get(self._type, {})
+
+  def sync_configuration(self, config, mapping, dry_run = False):
+    """
+    Synchronizes index settings and the type mapping by only applying the
+    differences from the current configuration. The index is closed only
+    when changed settings require it.
+
+    @param config: Desired index configuration
+    @param mapping: Desired type mapping
+    @param dry_run: Only report changes without applying them
+    @return: A list of change descriptions
+    """
+    current = self.get_settings()
+    if current is None:
+      if not dry_run:
+        self._es.create_index_if_missing(self._index, settings = config)
+        self._es.put_mapping(self._type, mapping, [self._index])
+      return ["create index {0}".format(self._index)]
+
+    desired = dict(
+      (key.replace("index.index.", "index."), value)
+      for key, value in _flatten_settings(config, "index.").iteritems()
+    )
+    changes = []
+    settings = {}
+    components = set()
+    for key, value in sorted(desired.iteritems()):
+      if current.get(key) == value:
+        continue
+      elif key in STATIC_SETTINGS:
+        changes.append("cannot change static setting {0} ({1} -> {2})".format(key, current.get(key), value))
+        continue
+
+      changes.append("setting {0}: {1} -> {2}".format(key, current.get(key), value))
+      if key.startswith("index.analysis."):
+        components.add(_analysis_component(key))
+      else:
+        settings[key] = value
+
+    # Entries that are no longer configured (e.g. removed list elements) are
+    # left behind unless the whole analysis component is replaced
+    for key in sorted(current):
+      if not key.startswith("index.analysis.") or key in desired:
+        continue
+
+      component = _analysis_component(key)
+      if any(x.startswith(component + ".") for x in desired):
+        changes.append("setting {0}: {1} -> None".format(key, current[key]))
+        components.add(component)
+
+    for component in components:
+      settings[component] = _settings_component(config, component[len("index."):])
+
+    # Analysis settings can only be changed on a closed index
+    if any(key.startswith("index.analysis.") for key in settings):
+      changes.append("index {0} will be closed to update analysis settings".format(self._index))
+
+    mapping_diffs = _mapping_diff(mapping, self.get_mapping())
+    for path in mapping_diffs:
+      changes.append("mapping {0}".format(path))
+
+    if not dry_run:
+      if settings:
+        self._update_settings(settings)
+      if mapping_diffs:
+        self._es.put_mapping(self._type, mapping, [self._index])
+
+    return changes
+
 class DocumentSearch(object):
   """
-  A container for Elastic Search connections.
+  A container for Elastic Search connections. The connection pool is only
+  created on first use.
   """
-  def __init__(self, servers, index_prefix):
+  def __init__(self, servers, index_prefix, options = None):
     """
     Class constructor.
     
     @param servers: A list of Elastic Search servers
     @param index_prefix: Index prefix
+    @param options: Connection pool options (timeouts, retries, backoff)
     """
-    self._es = pyes.ES(servers)
+    self._servers = servers
+    self._options = dict(options or {})
+    self._es = None
+    self._lock = threading.Lock()
     self._index_prefix = index_prefix
+
+  @property
+  def es(self):
+    """
+    Returns the Elastic Search connection pool, creating it if needed.
+    """
+    if self._es is None:
+      with self._lock:
+        if self._es is None:
+          self._es = SearchNodePool(self._servers, **self._options)
+
+    return self._es
+
+  def stats(self):
+    """
+    Returns connection pool statistics.
+    """
+    return self.es.stats()
   
   def index(self, name, typ):
     """
@@ -112,5 +580,5 @@ class DocumentSearch(object):
     @return: Elastic Search operations wrapper
     """
     name = "{0}.{1}".format(self._index_prefix, name)
-    return DocumentSearchIndex(self._es, name, typ)
+    return DocumentSearchIndex(self, name, typ)
 
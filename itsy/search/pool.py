@@ -0,0 +1,194 @@
+import itertools
+import threading
+import time
+
+import pyes
+import pyes.exceptions
+
+# Operations that may safely be retried on another node
+IDEMPOTENT_METHODS = frozenset([
+  "search_raw",
+  "search_scroll",
+  "get",
+  "index",
+  "delete",
+  "refresh",
+  "optimize",
+  "put_mapping",
+  "update_settings",
+  "open_index",
+  "close_index",
+  "create_index_if_missing",
+  "delete_index_if_exists",
+])
+
+# HTTP methods that may safely be retried for raw requests
+IDEMPOTENT_HTTP_METHODS = frozenset(["GET", "HEAD", "PUT", "DELETE"])
+
+class SearchNode(object):
+  """
+  A single Elastic Search node together with its health state.
+  """
+  def __init__(self, server, options):
+    """
+    Class constructor.
+
+    @param server: Server address
+    @param options: Additional options for pyes.ES
+    """
+    self.server = server
+    self.es = pyes.ES([server], **options)
+    self.requests = 0
+    self.failures = 0
+    self.consecutive_failures = 0
+    self.total_time = 0.0
+    self.dead_until = 0.0
+
+  def is_alive(self, now):
+    """
+    Returns true if the node is not backing off after failures.
+    """
+    return self.dead_until <= now
+
+class SearchNodePool(object):
+  """
+  A pool of Elastic Search nodes. Requests are distributed round-robin
+  across healthy nodes. Nodes that fail are marked dead with exponential
+  backoff and idempotent requests are retried on other nodes.
+  """
+  def __init__(self, servers, timeout = None, max_retries = 2, dead_backoff = 1.0,
+               max_dead_backoff = 60.0, **options):
+    """
+    Class constructor.
+
+    @param servers: A list of Elastic Search servers
+    @param timeout: Per-request timeout in seconds
+    @param max_retries: Maximum number of retries of idempotent requests
+    @param dead_backoff: Initial time a failed node is excluded for
+    @param max_dead_backoff: Maximum time a failed node is excluded for
+    @param options: Additional options for pyes.ES
+    """
+    if isinstance(servers, basestring):
+      servers = [servers]
+    if timeout is not None:
+      options['timeout'] = timeout
+
+    self._nodes = [SearchNode(server, options) for server in servers]
+    self._cycle = itertools.cycle(self._nodes)
+    self._lock = threading.Lock()
+    self.max_retries = max_retries
+    self.dead_backoff = dead_backoff
+    self.max_dead_backoff = max_dead_backoff
+    self.retries = 0
+
+  def _select(self, exclude):
+    """
+    Selects the next healthy node. When all nodes are dead, the node that
+    will be revived first is returned.
+
+    @param exclude: Nodes that have already failed for this request
+    """
+    now = time.time()
+    with self._lock:
+      for i in xrange(len(self._nodes)):
+        node = self._cycle.next()
+        if node.is_alive(now) and node not in exclude:
+          return node
+
+      candidates = [node for node in self._nodes if node not in exclude] or self._nodes
+      return min(candidates, key = lambda node: node.dead_until)
+
+  def _mark_failed(self, node):
+    """
+    Marks a node as dead with exponential backoff.
+    """
+    with self._lock:
+      node.failures += 1
+      node.consecutive_failures += 1
+      backoff = min(self.dead_backoff * 2 ** (node.consecutive_failures - 1), self.max_dead_backoff)
+      node.dead_until = time.time() + backoff
+
+  def _mark_succeeded(self, node, duration):
+    """
+    Marks a node as healthy.
+    """
+    with self._lock:
+      node.consecutive_failures = 0
+      node.dead_until = 0.0
+      node.total_time += duration
+
+  def _is_idempotent(self, method, args, kwargs):
+    """
+    Returns true if the given operation may be retried.
+    """
+    if method == "_send_request":
+      http_method = args[0] if args else kwargs.get("method")
+      return http_method in IDEMPOTENT_HTTP_METHODS
+
+    return method in IDEMPOTENT_METHODS
+
+  def call(self, method, *args, **kwargs):
+    """
+    Invokes a pyes.ES method on one of the nodes.
+
+    @param method: Method name
+    """
+    retries = self.max_retries if self._is_idempotent(method, args, kwargs) else 0
+    failed = []
+    while True:
+      node = self._select(failed)
+      with self._lock:
+        node.requests += 1
+
+      started = time.time()
+      try:
+        result = getattr(node.es, method)(*args, **kwargs)
+      except pyes.exceptions.ElasticSearchException:
+        # The node has responded, so it is healthy
+        self._mark_succeeded(node, time.time() - started)
+        raise
+      except Exception:
+        self._mark_failed(node)
+        failed.append(node)
+        if len(failed) > retries:
+          raise
+
+        with self._lock:
+          self.retries += 1
+        continue
+
+      self._mark_succeeded(node, time.time() - started)
+      return result
+
+  def __getattr__(self, name):
+    """
+    Returns a callable that invokes the given pyes.ES method on the pool.
+    Other attributes are not forwarded.
+    """
+    if name.startswith("__") or not callable(getattr(pyes.ES, name, None)):
+      raise AttributeError("'{0}' object has no attribute '{1}'".format(self.__class__.__name__, name))
+
+    def method(*args, **kwargs):
+      return self.call(name, *args, **kwargs)
+
+    return method
+
+  def stats(self):
+    """
+    Returns pool statistics.
+    """
+    now = time.time()
+    with self._lock:
+      return dict(
+        retries = self.retries,
+        nodes = [
+          dict(
+            server = node.server,
+            alive = node.is_alive(now),
+            requests = node.requests,
+            failures = node.failures,
+            avg_time = node.total_time / node.requests if node.requests else 0.0,
+          )
+          for node in self._nodes
+        ]
+      )
@@ -0,0 +1,219 @@
+import multiprocessing
+import threading
+import time
+import traceback
+
+from .. import concurrency, exceptions
+from ..metrics import metrics
+
+# Number of times operations rejected by the cluster are retried
+MAX_REJECTED_RETRIES = 10
+
+def _prepare_documents(documents):
+  """
+  Prepares bulk request lines that index a chunk of documents. Documents
+  that fail to prepare are skipped and reported.
+
+  @param documents: A list of documents
+  @return: A tuple (lines, failures) where failures is a list of (pk, traceback) tuples
+  """
+  lines = []
+  failures = []
+  for document in documents:
+    try:
+      if not document.should_save_to_search_index():
+        continue
+
+      document._load_deferred()
+      lines.extend(document._meta.search_engine.index_action(document._search_document(), document._version))
+    except Exception:
+      failures.append((document.pk, traceback.format_exc()))
+
+  return lines, failures
+
+def _init_process():
+  """
+  Initializes a process preparing documents. Database connections inherited
+  from the parent process are dropped and re-established on first use.
+  """
+  from ..connection import store
+  store.reset()
+
+class ReindexPipeline(object):
+  """
+  Reindexes documents using three overlapping stages connected by bounded
+  queues: reading documents from the database cursor, preparing search
+  documents (optionally in multiple processes) and sending bulk requests.
+  """
+  def __init__(self, document_class, bulk_size = 500, workers = 1, processes = 0, queue_size = 4,
+               throttle = None, on_progress = None, on_error = None):
+    """
+    Class constructor.
+
+    @param document_class: Document class to reindex
+    @param bulk_size: Number of documents in a single bulk request
+    @param workers: Number of threads preparing documents
+    @param processes: Number of processes preparing documents (0 to prepare in threads)
+    @param queue_size: Number of chunks that may wait between stages
+    @param throttle: Optional AdaptiveThrottle controlling the rate of bulk requests
+    @param on_progress: Optional callable invoked with the pipeline after each bulk request
+    @param on_error: Optional callable invoked with (pk, message) for each failed document
+    """
+    self.document_class = document_class
+    self.bulk_size = bulk_size
+    self.workers = max(workers, processes, 1)
+    self.processes = processes
+    self.queue_size = queue_size
+    self.throttle = throttle
+    self.on_progress = on_progress
+    self.on_error = on_error
+
+    self.read = 0
+    self.indexed = 0
+    self.failed = 0
+    self.last_pk = None
+    self._pipeline = None
+    self._completed = {}
+    self._next_sequence = 0
+    self._lock = threading.Lock()
+
+  def _read(self, documents):
+    """
+    Reads chunks of documents from the database cursor.
+    """
+    if hasattr(documents, 'iterator'):
+      cursor = documents.iterator(chunk_size = self.bulk_size, no_timeout = True)
+    else:
+      cursor = iter(documents)
+
+    for sequence, chunk in enumerate(concurrency.chunked(cursor, self.bulk_size)):
+      self.read += len(chunk)
+      yield sequence, chunk
+
+  def _error(self, pk, message):
+    """
+    Reports a failed document.
+    """
+    with self._lock:
+      self.failed += 1
+
+    if self.on_error is not None:
+      self.on_error(pk, message)
+
+  def _complete(self, sequence, chunk, indexed):
+    """
+    Marks a chunk as completed. Chunks may complete out of order, so the
+    last primary key is only advanced over consecutive completed chunks and
+    can be used to resume the reindex.
+    """
+    with self._lock:
+      self.indexed += indexed
+      self._completed[sequence] = chunk[-1].pk
+      while self._next_sequence in self._completed:
+        self.last_pk = self._completed.pop(self._next_sequence)
+        self._next_sequence += 1
+
+    self._publish_metrics()
+    if self.on_progress is not None:
+      self.on_progress(self)
+
+  def stats(self):
+    """
+    Returns statistics for each stage: number of processed documents,
+    throughput in documents per second and input queue depth in chunks.
+    """
+    if self._pipeline is None:
+      return {}
+
+    stages = [("read", self._pipeline.source)] + [(stage.name, stage) for stage in self._pipeline.stages]
+    chunk_size = float(self.read) / self._pipeline.source.processed if self._pipeline.source.processed else 0.0
+    result = {}
+    for name, stage in stages:
+      stats = stage.stats()
+      result[name] = {
+        'documents' : int(stats['processed'] * chunk_size),
+        'throughput' : stats['throughput'] * chunk_size,
+        'queue_depth' : stats['queue_depth'],
+        'queue_depth_max' : stats['queue_depth_max'],
+      }
+
+    return result
+
+  def _publish_metrics(self):
+    """
+    Publishes per-stage statistics to the metrics registry.
+    """
+    for name, stats in self.stats().iteritems():
+      for key, value in stats.iteritems():
+        metrics.set("reindex.{0}.{1}".format(name, key), value)
+
+  def run(self, documents):
+    """
+    Reindexes the given documents. Documents should be ordered by primary
+    key, so that the reindex can be resumed from `last_pk`.
+
+    @param documents: A DbResultSet or an iterable of documents to reindex
+    @return: Number of indexed documents
+    """
+    engine = self.document_class._meta.search_engine
+    pool = multiprocessing.Pool(self.processes, _init_process) if self.processes else None
+
+    def prepare(item):
+      sequence, chunk = item
+      if pool is not None:
+        lines, failures = pool.apply(_prepare_documents, (chunk,))
+      else:
+        lines, failures = _prepare_documents(chunk)
+
+      for pk, message in failures:
+        self._error(pk, message)
+
+      return sequence, chunk, lines
+
+    def send(item):
+      sequence, chunk, lines = item
+      indexed = len(lines) // 2
+      pending = lines
+      retries = 0
+      while pending:
+        if self.throttle is not None:
+          self.throttle.wait(len(pending) // 2)
+
+        started = time.time()
+        try:
+          engine.send_bulk(pending)
+          pending = None
+          if self.throttle is not None:
+            self.throttle.success(time.time() - started)
+        except exceptions.SearchBulkRejected, e:
+          # Retry rejected operations after backing off
+          pending = e.args[0]
+          retries += 1
+          if retries > MAX_REJECTED_RETRIES:
+            for i in xrange(len(pending) // 2):
+              self._error(None, "Rejected by the cluster.")
+            indexed -= len(pending) // 2
+            pending = None
+          elif self.throttle is not None:
+            self.throttle.rejected()
+          else:
+            time.sleep(retries)
+        except exceptions.SearchBulkError, e:
+          for error in e.args[0]:
+            self._error(None, error)
+          indexed -= len(e.args[0])
+          pending = None
+
+      self._complete(sequence, chunk, indexed)
+
+    self._pipeline = concurrency.Pipeline(self.queue_size)
+    self._pipeline.add_stage(prepare, workers = self.workers)
+    self._pipeline.add_stage(send)
+    try:
+      self._pipeline.run(self._read(documents))
+    finally:
+      if pool is not None:
+        pool.terminate()
+
+    self._publish_metrics()
+    return self.indexed
@@ -0,0 +1,162 @@
+import threading
+import time
+
+from ..connection import store
+from ..metrics import metrics
+
+# Collection holding reindex control flags; flags are stored in the database
+# so that they are seen by reindexes running in all processes
+CONTROL_COLLECTION = "itsy.reindex"
+
+def _control_key(doc_class):
+  """
+  Returns the identifier of the control document for a document class.
+  """
+  return "{0}.{1}".format(doc_class._meta.collection_base, doc_class._meta.classname)
+
+def pause(doc_class):
+  """
+  Pauses all throttled reindex operations of the given document class.
+
+  @param doc_class: Document class
+  """
+  store.collection(CONTROL_COLLECTION).update(
+    { "_id" : _control_key(doc_class) },
+    { "$set" : { "paused" : True, "updated" : time.time() } },
+    upsert = True,
+    safe = True
+  )
+
+def resume(doc_class):
+  """
+  Resumes paused reindex operations of the given document class.
+
+  @param doc_class: Document class
+  """
+  store.collection(CONTROL_COLLECTION).update(
+    { "_id" : _control_key(doc_class) },
+    { "$set" : { "paused" : False, "updated" : time.time() } },
+    upsert = True,
+    safe = True
+  )
+
+def is_paused(doc_class):
+  """
+  Returns True when reindex operations of the given document class are paused.
+
+  @param doc_class: Document class
+  """
+  state = store.collection(CONTROL_COLLECTION).find_one({ "_id" : _control_key(doc_class) })
+  return bool(state is not None and state.get("paused"))
+
+def celery_queue_depth(queue):
+  """
+  Returns the number of messages waiting in a Celery queue.
+
+  @param queue: Queue name
+  """
+  from celery import current_app
+
+  connection = current_app.broker_connection()
+  try:
+    return connection.default_channel.queue_declare(queue = queue, passive = True)[1]
+  finally:
+    connection.release()
+
+class AdaptiveThrottle(object):
+  """
+  Limits the rate (in documents per second) at which a reindex sends bulk
+  requests. The rate is increased additively while bulk requests complete
+  within the target latency and decreased multiplicatively when they are
+  slow or rejected by the cluster, but never exceeds the configured ceiling.
+  When the initial rate is None, the rate is not limited. Sending is held
+  back while the reindex is paused or while the Celery queue is too deep, so
+  that regular indexing tasks are not starved.
+  """
+  def __init__(self, doc_class, config = None):
+    """
+    Class constructor.
+
+    @param doc_class: Document class being reindexed
+    @param config: Throttle configuration
+    """
+    config = config or {}
+    self.doc_class = doc_class
+    self.max_rate = config.get("max_rate")
+    self.min_rate = float(config.get("min_rate", 10.0))
+    self.rate_step = float(config.get("rate_step", 50.0))
+    self.target_latency = float(config.get("target_latency", 1.0))
+    self.celery_queue = config.get("celery_queue")
+    self.max_queue_depth = config.get("max_queue_depth", 1000)
+    self.check_interval = float(config.get("check_interval", 5.0))
+    self.rate = config.get("initial_rate", 100.0)
+    if self.rate is not None:
+      self.rate = float(self.rate)
+      if self.max_rate:
+        self.rate = min(self.rate, float(self.max_rate))
+
+    self._next_send = time.time()
+    self._next_check = 0.0
+    self._lock = threading.Lock()
+
+  def _held_back(self):
+    """
+    Returns True when sending should be held back.
+    """
+    if is_paused(self.doc_class):
+      return True
+
+    if self.celery_queue is not None and celery_queue_depth(self.celery_queue) > self.max_queue_depth:
+      return True
+
+    return False
+
+  def wait(self, count):
+    """
+    Blocks until the given number of documents may be sent.
+
+    @param count: Number of documents
+    """
+    if time.time() >= self._next_check:
+      while self._held_back():
+        metrics.increment("reindex.throttle.held_back")
+        time.sleep(self.check_interval)
+      self._next_check = time.time() + self.check_interval
+
+    with self._lock:
+      now = time.time()
+      start = max(now, self._next_send)
+      if self.rate is not None:
+        self._next_send = start + count / self.rate
+
+    if start > now:
+      time.sleep(start - now)
+
+  def success(self, latency):
+    """
+    Records a completed bulk request.
+
+    @param latency: Duration of the request in seconds
+    """
+    with self._lock:
+      if self.rate is None:
+        return
+      elif latency > self.target_latency:
+        self.rate = max(self.min_rate, self.rate * 0.75)
+      else:
+        self.rate += self.rate_step
+        if self.max_rate:
+          self.rate = min(self.rate, float(self.max_rate))
+
+      metrics.set("reindex.throttle.rate", self.rate)
+
+  def rejected(self):
+    """
+    Records a bulk request rejected by the cluster and delays further sending.
+    """
+    with self._lock:
+      self._next_send = max(self._next_send, time.time() + self.target_latency)
+      metrics.increment("reindex.throttle.rejections")
+      if self.rate is not None:
+        self.rate = max(self.min_rate, self.rate * 0.5)
+        metrics.set("reindex.throttle.rate", self.rate)
@@ -0,0 +1,180 @@
+from .. import concurrency
+from ..resultset import DbResultSet
+
+def search_versions(document_class, pks):
+  """
+  Looks up versions of the given documents in the search index. Document
+  sources are not fetched.
+
+  @param document_class: Document class
+  @param pks: A list of primary keys
+  @return: A dictionary mapping primary keys of indexed documents to (search identifier, version) tuples
+  """
+  engine = document_class._meta.search_engine
+  pk_field = document_class._meta.get_primary_key_field()
+  query = {
+    "query" : { "ids" : { "values" : [pk_field.to_search(pk, None) for pk in pks] } },
+    "fields" : [],
+    "version" : True,
+  }
+
+  results = engine.search(query, size = len(pks))
+  return dict(
+    (pk_field.from_search(hit['_id'], None), (hit['_id'], hit.get('_version')))
+    for hit in results['hits']['hits']
+  )
+
+def search_identifiers(document_class, batch_size = 1000, keep_alive = "5m"):
+  """
+  Streams (pk, search identifier) tuples of all indexed documents of the
+  given class in no particular order. The scan search type is used, so no
+  field needs to be sortable. Document sources are not fetched.
+
+  @param document_class: Document class
+  @param batch_size: Number of hits fetched per request (per shard)
+  @param keep_alive: How long should the scroll context be kept alive between requests
+  """
+  engine = document_class._meta.search_engine
+  pk_field = document_class._meta.get_primary_key_field()
+  query = {
+    "query" : { "match_all" : {} },
+    "fields" : [],
+  }
+
+  # The scan search type returns no hits in the first response
+  results = engine.search(query, size = batch_size, scroll = keep_alive, search_type = "scan")
+  scroll_id = results.get('_scroll_id')
+  try:
+    while True:
+      results = engine.scroll(scroll_id, keep_alive)
+      scroll_id = results.get('_scroll_id', scroll_id)
+      hits = results['hits']['hits']
+      if not hits:
+        return
+
+      for hit in hits:
+        yield pk_field.from_search(hit['_id'], None), hit['_id']
+  finally:
+    if scroll_id is not None:
+      engine.clear_scroll(scroll_id)
+
+class IndexVerifier(object):
+  """
+  Compares the database with the search index. Documents are read from the
+  database in chunks and looked up in the index by identifier, yielding
+  ("index", pk) for documents that are missing or outdated in the index.
+  When all documents are being verified, index entries are then scanned and
+  ("delete", search identifier) is yielded for entries without a document
+  in the database.
+
+  Modifications that don't affect any searchable field are not indexed, so
+  a document is only outdated when the index holds a version older than the
+  last modification that affected the search index.
+  """
+  def __init__(self, document_class, since = None, batch_size = 1000):
+    """
+    Class constructor.
+
+    @param document_class: Document class
+    @param since: Optional datetime; only documents updated since then are verified
+      (requires a revisable document class, as others don't record update times)
+    @param batch_size: Number of documents looked up per request
+    """
+    if since is not None and not document_class._meta.revisable:
+      raise ValueError("Document '{0}' is not revisable and cannot be verified since a given time!".format(document_class.__name__))
+
+    self.document_class = document_class
+    self.since = since
+    self.batch_size = batch_size
+    self.missing = 0
+    self.outdated = 0
+    self.orphaned = 0
+
+  def _db_versions(self):
+    """
+    Streams (pk, version) pairs of documents in the database, ordered by
+    primary key. Versions are those of the last modifications that affected
+    the search index.
+    """
+    if self.since is not None:
+      cursor = self.document_class._meta.collection.find({ "_last_update" : { "$gte" : self.since } })
+      documents = DbResultSet(self.document_class, {}, cursor)
+    else:
+      documents = self.document_class.find().read_preference("PRIMARY")
+
+    pk_field = self.document_class._meta.get_primary_key_field()
+    for pk, version in documents.order_by("pk").versions(no_timeout = True, search = True):
+      yield pk_field.from_store(pk, None), version
+
+  def __iter__(self):
+    """
+    Performs the comparison.
+    """
+    for chunk in concurrency.chunked(self._db_versions(), self.batch_size):
+      indexed = search_versions(self.document_class, [pk for pk, version in chunk])
+      for pk, version in chunk:
+        entry = indexed.get(pk)
+        if entry is None:
+          self.missing += 1
+          yield "index", pk
+        elif entry[1] is None or (version is not None and entry[1] < version):
+          self.outdated += 1
+          yield "index", pk
+
+    # Documents not updated since the given time are not being verified
+    if self.since is not None:
+      return
+
+    pk_field = self.document_class._meta.get_primary_key_field()
+    for chunk in concurrency.chunked(search_identifiers(self.document_class, self.batch_size), self.batch_size):
+      existing = set(
+        pk_field.from_store(pk, None)
+        for pk in self.document_class.find(pk__in = [pk for pk, search_id in chunk]).read_preference("PRIMARY").ids()
+      )
+      for pk, search_id in chunk:
+        if pk not in existing:
+          self.orphaned += 1
+          yield "delete", search_id
+
+def reindex_stale(pipeline, since = None, batch_size = 1000):
+  """
+  Reindexes only documents that are missing or outdated in the search index
+  and removes orphaned index entries using bulk requests.
+
+  @param pipeline: ReindexPipeline used to reindex documents
+  @param since: Optional datetime; only documents updated since then are verified
+  @param batch_size: Number of documents looked up per request
+  @return: The IndexVerifier holding counts of stale entries
+  """
+  document_class = pipeline.document_class
+  engine = document_class._meta.search_engine
+  verifier = IndexVerifier(document_class, since, batch_size)
+
+  def delete(search_ids):
+    engine.send_bulk([engine.delete_action(search_id) for search_id in search_ids])
+
+  def stale_documents():
+    pks = []
+    orphans = []
+    for action, value in verifier:
+      if action == "delete":
+        orphans.append(value)
+        if len(orphans) >= pipeline.bulk_size:
+          delete(orphans)
+          orphans = []
+        continue
+
+      pks.append(value)
+      if len(pks) >= pipeline.bulk_size:
+        for document in document_class.find(pk__in = pks).read_preference("PRIMARY").defer(None).order_by("pk"):
+          yield document
+        pks = []
+
+    if pks:
+      for document in document_class.find(pk__in = pks).read_preference("PRIMARY").defer(None).order_by("pk"):
+        yield document
+    if orphans:
+      delete(orphans)
+
+  pipeline.run(stale_documents())
+  return verifier
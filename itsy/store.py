@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 import pymongo
+import threading
 import types
 
 def _find_and_modify(self, query = {}, update = None, upsert = False, **kwargs):
@@ -33,28 +34,144 @@ def _find_and_modify(self, query = {}, update = None, upsert = False, **kwargs):
 
   return out['value']
 
+def resolve_read_preference(preference):
+  """
+  Converts a read preference name (for example "SECONDARY_PREFERRED") into
+  a pymongo read preference.
+
+  @param preference: Read preference or its name
+  """
+  if isinstance(preference, basestring):
+    return getattr(pymongo.ReadPreference, preference.upper())
+
+  return preference
+
+def set_read_preference(cursor, preference):
+  """
+  Routes reads of the given cursor according to the given read preference.
+
+  @param cursor: A pymongo.Cursor instance
+  @param preference: A pymongo.ReadPreference value or its name
+  """
+  preference = resolve_read_preference(preference)
+  cursor._Cursor__read_preference = preference
+  cursor._Cursor__slave_okay = preference != pymongo.ReadPreference.PRIMARY
+  return cursor
+
+class LazyCollection(object):
+  """
+  A proxy for a MongoDB collection that connects to the database on
+  first use.
+  """
+  def __init__(self, store, name, kwargs):
+    """
+    Class constructor.
+
+    @param store: Document store
+    @param name: Collection name
+    @param kwargs: Additional arguments for the collection
+    """
+    self._store = store
+    self._name = name
+    self._kwargs = kwargs
+    self._collection = None
+
+  def _resolve(self):
+    """
+    Returns the actual pymongo.Collection instance.
+    """
+    if self._collection is None:
+      self._collection = self._store._create_collection(self._name, **self._kwargs)
+
+    return self._collection
+
+  def __getattr__(self, name):
+    """
+    Forwards attribute access to the actual collection.
+    """
+    return getattr(self._resolve(), name)
+
 class DocumentStore(object):
   """
-  A container for MongoDB connections.
+  A container for MongoDB connections. The connection is only established
+  on first use.
   """
-  def __init__(self, servers, database):
+  def __init__(self, servers, database, options = None):
     """
     Class constructor.
     
     @param servers: A list of servers
     @param database: Database name
+    @param options: Connection options (pool size, timeouts, read preference, write concern);
+      a read preference other than PRIMARY requires the replicaSet option
+    """
+    self._servers = servers
+    self._database = database
+    self._options = dict(options or {})
+    self._db = None
+    self._collections = {}
+    self._lock = threading.Lock()
+
+    # The read preference is only a default for result sets, so that other
+    # reads (refreshes, loading of deferred fields) always use the primary
+    self.read_preference = resolve_read_preference(self._options.pop('read_preference', None))
+
+    # Plain connections never route reads to secondaries, so a replica set
+    # client is required (the replicaSet option must be given as well)
+    self._replica_set = self.read_preference not in (None, pymongo.ReadPreference.PRIMARY)
+
+  @property
+  def db(self):
     """
-    self._db = getattr(pymongo.Connection(servers), database)
+    Returns the database handle, connecting to the database if needed.
+    """
+    if self._db is None:
+      with self._lock:
+        if self._db is None:
+          if self._replica_set:
+            connection = pymongo.MongoReplicaSetClient(self._servers, **self._options)
+          else:
+            connection = pymongo.Connection(self._servers, **self._options)
+
+          self._db = getattr(connection, self._database)
+
+    return self._db
 
   def collection(self, name, **kwargs):
     """
-    Returns the specified MongoDB collection.
+    Returns the specified MongoDB collection. The returned collection only
+    connects to the database on first use. Collection handles are cached.
     
+    @param name: Collection name
+    @return: A collection proxy
+    """
+    key = (name, tuple(sorted(kwargs.items())))
+    with self._lock:
+      if key not in self._collections:
+        self._collections[key] = LazyCollection(self, name, kwargs)
+
+      return self._collections[key]
+
+  def reset(self):
+    """
+    Drops the database connection, so that it is re-established on next use.
+    This must be called in forked processes, which may not share connections
+    with their parent.
+    """
+    with self._lock:
+      self._db = None
+      for collection in self._collections.values():
+        collection._collection = None
+
+  def _create_collection(self, name, **kwargs):
+    """
+    Creates the specified MongoDB collection.
+
     @param name: Collection name
     @return: A pymongo.Collection instance
     """
     output = pymongo.collection.Collection(
-      self._db,
+      self.db,
       name,
       create = False,
       **kwargs
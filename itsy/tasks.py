@@ -2,6 +2,9 @@ import time
 
 from celery.task import task as celery_task
 
+# Number of consecutive failed attempts after which a reindex gives up
+REINDEX_MAX_RETRIES = 5
+
 @celery_task(max_retries = 3)
 def cache_resync(source_doc_class, source_doc_id, doc_class, doc_id, fields):
   """
@@ -51,53 +54,176 @@ def cache_spawn_syncers(doc_class, doc_id, modified_fields):
   for (d_class, d_id), fields in document.get_reverse_references(modified_fields).iteritems():
     cache_resync.delay(doc_class, doc_id, d_class, d_id, fields)
 
+@celery_task()
+def cache_spawn_syncers_batch(doc_class, doc_ids, modified_fields):
+  """
+  Spawns tasks for syncing cached reference fields for a batch of source
+  documents using a single database query.
+
+  @param doc_class: Document class
+  @param doc_ids: A list of document identifiers
+  @param modified_fields: Fields that have been modified
+  """
+  for document in doc_class.find(pk__in = doc_ids).read_preference("PRIMARY"):
+    for (d_class, d_id), fields in document.get_reverse_references(modified_fields).iteritems():
+      cache_resync.delay(doc_class, document.pk, d_class, d_id, fields)
+
 @celery_task(max_retries = 3)
-def search_index_update(doc_class, doc_id):
+def search_index_update(doc_class, doc_id, modified_fields = None):
   """
   Updates the search index for the given document.
   
   @param document: Source document
+  @param modified_fields: Optional names of modified fields for partial updates
   """
-  from .document import DocumentSource
+  from .connection import search_cache
 
   try:
     document = doc_class.get(pk = doc_id)
-    document.save(target = DocumentSource.Search)
+    document._save_to_search(fields = modified_fields)
+    search_cache.invalidate(doc_class)
   except doc_class.DoesNotExist:
     return
   except Exception, e:
     search_index_update.retry(exc = e)
 
 @celery_task(max_retries = 3)
-def search_index_remove(doc_class, doc_id):
+def search_index_update_batch(doc_class, doc_ids):
+  """
+  Updates the search index for a batch of documents using a single
+  database query and bulk requests. Fetching documents, preparing them and
+  sending bulk requests are pipelined, so the stages overlap.
+
+  @param doc_class: Document class
+  @param doc_ids: A list of document identifiers
+  """
+  from . import concurrency
+  from .connection import search_cache
+  from .resultset import BULK_CHUNK_SIZE
+
+  engine = doc_class._meta.search_engine
+
+  def prepare(documents):
+    # Lines are kept local to this task instead of using the shared queue of
+    # bulk operations, which may contain operations of other threads
+    lines = []
+    for document in documents:
+      if document.should_save_to_search_index():
+        document._load_deferred()
+        lines.extend(engine.index_action(document._search_document(), document._version))
+    return lines
+
+  def send(lines):
+    engine.send_bulk(lines)
+
+  try:
+    pipeline = concurrency.Pipeline(queue_size = 2)
+    pipeline.add_stage(prepare).add_stage(send)
+    pipeline.run(concurrency.chunked(doc_class.find(pk__in = doc_ids).read_preference("PRIMARY").defer(None).iterator(), BULK_CHUNK_SIZE))
+    search_cache.invalidate(doc_class)
+  except Exception, e:
+    search_index_update_batch.retry(exc = e)
+
+@celery_task(max_retries = 3)
+def search_index_remove(doc_class, doc_id, version = None):
   """
   Removes a document from the search index.
   
   @param document: Document to remove
+  @param version: Optional last version of the removed document
   """
+  from .connection import search_cache
+
   try:
-    doc_class._meta.search_engine.delete(doc_id)
+    doc_class._meta.search_engine.delete(doc_id, version = version)
+    search_cache.invalidate(doc_class)
   except Exception, e:
     search_index_remove.retry(exc = e)
 
+@celery_task(max_retries = 3)
+def search_index_remove_batch(doc_class, doc_ids, versions = None):
+  """
+  Removes a batch of documents from the search index using a single bulk
+  request.
+
+  @param doc_class: Document class
+  @param doc_ids: A list of document identifiers (formatted for search)
+  @param versions: Optional list of last versions of the removed documents
+  """
+  from .connection import search_cache
+
+  if versions is None:
+    versions = [None] * len(doc_ids)
+
+  try:
+    engine = doc_class._meta.search_engine
+    engine.send_bulk([engine.delete_action(doc_id, version) for doc_id, version in zip(doc_ids, versions)])
+    search_cache.invalidate(doc_class)
+  except Exception, e:
+    search_index_remove_batch.retry(exc = e)
+
 @celery_task()
 def search_index_reindex(document_cls, offset = 0, batch_size = 1000):
   """
-  Performs a complete reindex of documents in the database.
+  Performs a complete reindex of documents in the database, starting at the
+  given document offset. This task is kept so that tasks queued by earlier
+  versions still run; new reindexes use `search_index_reindex_pipeline`.
 
   @param document_cls: Document class to reindex
   @param offset: Starting document offset
+  @param batch_size: Unused
   """
+  start_pk = None
+  if offset:
+    for document in document_cls.find().read_preference("PRIMARY").only("pk").order_by("pk").skip(offset - 1).limit(1):
+      start_pk = document.pk
+
+  search_index_reindex_pipeline(document_cls, start_pk = start_pk)
+
+@celery_task()
+def search_index_reindex_pipeline(document_cls, start_pk = None, bulk_size = 500, max_rate = None,
+                                  verify = False, since = None):
+  """
+  Performs a complete reindex of documents in the database. The rate of
+  indexing adapts to cluster load and may be paused. After a failure, the
+  reindex resumes from the last completely indexed chunk; it gives up when
+  REINDEX_MAX_RETRIES consecutive attempts fail without making progress.
+
+  @param document_cls: Document class to reindex
+  @param start_pk: Optional primary key after which to start
+  @param bulk_size: Number of documents sent in a single bulk request
+  @param max_rate: Optional maximum number of documents indexed per second
+  @param verify: Should only missing or outdated documents be reindexed
+  @param since: Optional datetime; only documents updated since then are verified
+  """
+  from django.conf import settings
+  from .search.reindex import ReindexPipeline
+  from .search.throttle import AdaptiveThrottle
+  from .search.verify import reindex_stale
+
+  config = dict(getattr(settings, "ITSY_REINDEX_THROTTLE", None) or {})
+  if max_rate is not None:
+    config["max_rate"] = max_rate
+  throttle = AdaptiveThrottle(document_cls, config)
+
+  failures = 0
   while True:
+    pipeline = ReindexPipeline(document_cls, bulk_size = bulk_size, throttle = throttle)
     try:
-      count = 0
-      for document in document_cls.find().only("pk").order_by("pk").skip(offset).limit(batch_size):
-        search_index_update.delay(document_cls, document.pk)
-        count += 1
-        time.sleep(0.1)
-
-      offset += batch_size
-      if count < batch_size:
-        break
-    except:
+      if verify or since is not None:
+        reindex_stale(pipeline, since = since)
+      else:
+        criteria = {} if start_pk is None else { 'pk__gt' : start_pk }
+        pipeline.run(document_cls.find(**criteria).read_preference("PRIMARY").defer(None).order_by("pk"))
+      break
+    except Exception:
+      # Resume after the last completely indexed chunk
+      if pipeline.last_pk is not None:
+        start_pk = pipeline.last_pk
+        failures = 0
+
+      failures += 1
+      if failures > REINDEX_MAX_RETRIES:
+        raise
+
       time.sleep(1.0)
@@ -0,0 +1,190 @@
+from __future__ import absolute_import
+
+import unittest
+
+from . import concurrency
+from .document import Document
+from .resultset import DbResultSet, SearchResultSet
+
+class FakeCursor(object):
+  """
+  A stand-in for a pymongo cursor over a list of documents.
+  """
+  def __init__(self, documents):
+    self.documents = documents
+    self.clones = []
+    self.iterated = False
+    self.counted = False
+
+  def count(self, with_limit_and_skip = False):
+    self.counted = True
+    return len(self.documents)
+
+  def clone(self):
+    cursor = FakeCursor(self.documents)
+    self.clones.append(cursor)
+    return cursor
+
+  def __iter__(self):
+    self.iterated = True
+    return iter(self.documents)
+
+class FakeDocument(object):
+  """
+  A stand-in for a document class that records the data it was loaded from.
+  """
+  data = None
+  source = None
+
+  def _set_from_db(self, data):
+    self.data = data
+    self.source = "db"
+
+  def _set_from_search(self, data, highlight = None):
+    self.data = data
+    self.source = "search"
+
+class FakeQuery(object):
+  """
+  A stand-in for a pyes.Query.
+  """
+  def serialize(self):
+    return { "match_all" : {} }
+
+class FakeSearchEngine(object):
+  """
+  A stand-in for a document search index that returns fixed hits.
+  """
+  def __init__(self, hits):
+    self.hits = hits
+    self.requests = []
+
+  def search(self, query, **params):
+    self.requests.append((query, params))
+    return { "hits" : { "total" : len(self.hits), "hits" : self.hits } }
+
+class FakePagedSearchEngine(object):
+  """
+  A stand-in for a document search index holding a number of documents,
+  which honors the `from` and `size` request parameters.
+  """
+  def __init__(self, count):
+    self.count = count
+    self.requests = []
+
+  def search(self, query, **params):
+    self.requests.append((params['from'], params['size']))
+    hits = [
+      { "_id" : str(i), "_source" : { "title" : i } }
+      for i in xrange(params['from'], min(self.count, params['from'] + params['size']))
+    ]
+    return { "hits" : { "total" : self.count, "hits" : hits } }
+
+class FakeSearchMeta(object):
+  def __init__(self, engine):
+    self.search_engine = engine
+
+class FakeSavedDocument(object):
+  """
+  A stand-in for a document that records the order of saves.
+  """
+  asave = Document.asave.im_func
+
+  def __init__(self, log, name, fail = False):
+    self.log = log
+    self.name = name
+    self.fail = fail
+
+  def save(self, **kwargs):
+    self.log.append((self.name, kwargs))
+    if self.fail:
+      raise ValueError(self.name)
+
+class AsyncOperationsTestCase(unittest.TestCase):
+  """
+  Tests asynchronous operations using a synchronous executor, so that their
+  outcome is deterministic.
+  """
+  def setUp(self):
+    self.previous_executor = concurrency.set_executor(concurrency.SynchronousExecutor())
+
+  def tearDown(self):
+    concurrency.set_executor(self.previous_executor)
+
+  def test_afetch(self):
+    cursor = FakeCursor([{ "_id" : 1 }, { "_id" : 2 }])
+    future = DbResultSet(FakeDocument, {}, cursor).afetch()
+
+    self.assertTrue(future.done())
+    self.assertEqual([document.data for document in future.result()], [{ "_id" : 1 }, { "_id" : 2 }])
+    self.assertTrue(all(document.source == "db" for document in future.result()))
+
+    # A clone of the result set is evaluated, the original cursor is left intact
+    self.assertEqual(len(cursor.clones), 1)
+    self.assertTrue(cursor.clones[0].iterated)
+    self.assertFalse(cursor.clones[0].counted)
+    self.assertFalse(cursor.iterated)
+
+  def test_aevaluate(self):
+    engine = FakeSearchEngine([{ "_id" : "1", "_source" : { "title" : "a" } }])
+    FakeDocument._meta = FakeSearchMeta(engine)
+    try:
+      future = SearchResultSet(FakeDocument, FakeQuery()).cache(False).aevaluate()
+    finally:
+      del FakeDocument._meta
+
+    self.assertTrue(future.done())
+    self.assertEqual([document.data for document in future.result()], [{ "title" : "a" }])
+    self.assertEqual(len(engine.requests), 1)
+
+  def test_asave_ordering(self):
+    log = []
+    futures = [
+      FakeSavedDocument(log, "first").asave(snapshot = False),
+      FakeSavedDocument(log, "second", fail = True).asave(),
+      FakeSavedDocument(log, "third").asave(tasks = False),
+    ]
+
+    # Saves are performed in submission order and failures are reported
+    # through futures without affecting later saves
+    self.assertEqual(log, [("first", { "snapshot" : False }), ("second", {}), ("third", { "tasks" : False })])
+    self.assertTrue(all(future.done() for future in futures))
+    self.assertIsNone(futures[0].exception())
+    self.assertIsInstance(futures[1].exception(), ValueError)
+    self.assertRaises(ValueError, futures[1].result)
+    self.assertIsNone(futures[2].result())
+
+class SearchPagingTestCase(unittest.TestCase):
+  """
+  Tests that indexing and slicing search result sets only fetch the pages
+  covering the requested items.
+  """
+  def setUp(self):
+    self.engine = FakePagedSearchEngine(23)
+    FakeDocument._meta = FakeSearchMeta(self.engine)
+
+  def tearDown(self):
+    del FakeDocument._meta
+
+  def result_set(self):
+    return SearchResultSet(FakeDocument, FakeQuery()).cache(False).paged(10)
+
+  def test_slice_later_page(self):
+    documents = self.result_set()[12:14]
+    self.assertEqual([document.data["title"] for document in documents], [12, 13])
+    self.assertEqual(self.engine.requests, [(10, 10)])
+
+  def test_open_slice(self):
+    documents = self.result_set()[15:]
+    self.assertEqual([document.data["title"] for document in documents], range(15, 23))
+    self.assertEqual(self.engine.requests, [(10, 10), (20, 10)])
+
+  def test_negative_slice(self):
+    documents = self.result_set()[-2:]
+    self.assertEqual([document.data["title"] for document in documents], [21, 22])
+    self.assertEqual(self.engine.requests, [(0, 10), (20, 10)])
+
+  def test_count_only(self):
+    result_set = self.result_set().count_only()
+    self.assertEqual(len(result_set), 23)
+    self.assertEqual(self.engine.requests, [(0, 0)])